@@ -1,10 +1,38 @@
+import io
+import csv
+import gzip
 import os
+import json
+import hashlib
+import hmac
+import re
+import select
+import sqlite3
+import uuid
+import atexit
+import bisect
+import functools
 import time
 import math
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import click
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from flask import Flask, render_template, request, redirect, session
+import psycopg2.extensions
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from flask import Flask, render_template, request, redirect, session, g, jsonify, Response, has_request_context, stream_with_context
+from flask import before_render_template, template_rendered
+from markupsafe import Markup, escape
+from jinja2 import FileSystemBytecodeCache
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Облако для картинок
@@ -12,6 +40,18 @@ import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 
+# Превью для локального хранилища фото (для Cloudinary не нужно — он режет по URL)
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# brotli для предсжатого CSS; без него отдаем только gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # ЗАЩИТА ОТ CSRF
 from flask_wtf.csrf import CSRFProtect
 
@@ -46,19 +86,646 @@ cloudinary.config(
 )
 # =================================================================
 
+# =================================================================
+# 👇 ПУЛ СОЕДИНЕНИЙ (один на воркер gunicorn) 👇
+# =================================================================
+# Размер пула задается на воркер: workers * DB_POOL_MAX должно влезать
+# в лимит соединений базы (у Neon он зависит от тарифа).
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))      # сколько ждать свободное соединение
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', 30)) # после скольки секунд простоя проверять SELECT 1
+
+
+class DBPool:
+    """Ограниченный пул соединений с проверкой здоровья и статистикой ожидания."""
+
+    def __init__(self, dsn, minconn, maxconn, timeout, ping_after, connection_factory=None):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, dsn, connection_factory=connection_factory)
+        # minconn у psycopg2 — это и сколько открыть сразу, и сколько держать простаивающими: лишние
+        # putconn закрывает. При MIN=1 почти каждый параллельный запрос открывал бы новое соединение,
+        # поэтому открываем minconn, а храним до maxconn
+        self._pool.minconn = maxconn
+        # ThreadedConnectionPool не умеет ждать (сразу PoolError), поэтому очередь держим семафором
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._idle_since = {}
+        self._in_use = 0
+        self._stats = {'acquired': 0, 'waited': 0, 'wait_total': 0.0, 'wait_max': 0.0,
+                       'timeouts': 0, 'discarded': 0, 'in_use_max': 0}
+
+    def acquire(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise pg_pool.PoolError(f"нет свободных соединений за {self.timeout} сек")
+        waited = time.perf_counter() - start
+        try:
+            conn = self._checked(self._pool.getconn())
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._stats['acquired'] += 1
+            self._stats['in_use_max'] = max(self._stats['in_use_max'], self._in_use)
+            self._stats['wait_total'] += waited
+            self._stats['wait_max'] = max(self._stats['wait_max'], waited)
+            if waited > 0.001:
+                self._stats['waited'] += 1
+        return conn
+
+    def _checked(self, conn):
+        # Соединение, которое долго лежало без дела, могло умереть (Neon усыпляет простаивающие).
+        # После пробуждения мертвы обычно все простаивающие — проверяем каждое следующее, пока пул
+        # не отдаст живое или не откроет новое (у нового нет отметки простоя, его не пингуем).
+        while True:
+            idle_since = self._idle_since.pop(id(conn), None)
+            if not conn.closed and (idle_since is None or time.time() - idle_since < self.ping_after):
+                return conn
+            if not conn.closed:
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT 1")
+                    conn.rollback()
+                    return conn
+                except psycopg2.Error:
+                    pass
+            with self._lock:
+                self._stats['discarded'] += 1
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+
+    def release(self, conn, broken=False):
+        try:
+            if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()  # незакоммиченное (в т.ч. после ошибки) не должно достаться следующему запросу
+        except psycopg2.Error:
+            broken = True
+        broken = broken or bool(conn.closed)
+        if not broken:
+            self._idle_since[id(conn)] = time.time()
+        self._pool.putconn(conn, close=broken)
+        if conn.closed:
+            self._idle_since.pop(id(conn), None)  # id() закрытого соединения может достаться новому
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['in_use'] = self._in_use
+        data['max'] = self.maxconn
+        data['idle'] = len(self._pool._pool)
+        data['saturation'] = round(data['in_use'] / self.maxconn, 2)
+        data['wait_avg'] = data['wait_total'] / data['acquired'] if data['acquired'] else 0.0
+        return data
+
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    # Пул создаем лениво и заново после fork: соединения нельзя делить между процессами
+    global _db_pool, _db_pool_pid
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != os.getpid():
+                _db_pool = DBPool(DB_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_AFTER,
+                                  connection_factory=InstrumentedConnection)
+                _db_pool_pid = os.getpid()
+    return _db_pool
+
 def get_db_connection():
+    # Одно соединение на запрос (app context): берется из пула при первом вызове,
+    # возвращается в release_db_connection. Закрывать его руками не нужно.
+    if 'db' in g:
+        return g.db
     try:
-        conn = psycopg2.connect(DB_URL)
-        return conn
+        g.db = get_db_pool().acquire()
+        return g.db
     except Exception as e:
         print(f"❌ Ошибка подключения к базе Neon: {e}")
         return None
 
-def init_db():
-    conn = get_db_connection()
-    if not conn: return
-    cursor = conn.cursor()
+@app.teardown_appcontext
+def release_db_connection(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_db_pool().release(conn, broken=isinstance(exc, psycopg2.OperationalError))
+
+# =================================================================
+# 👇 КЭШИ ВОРКЕРА И ОБЩИЕ "ВЕРСИИ" ДЛЯ СБРОСА МЕЖДУ ВОРКЕРАМИ 👇
+# =================================================================
+# Кэши живут в памяти каждого воркера. Чтобы запись в одном воркере сбрасывала кэш
+# во всех, версия хранится как mtime файла в CACHE_DIR (все воркеры на одной машине).
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'yohkecar-cache'))
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+
+_process_token = (None, None)
+
+def process_token():
+    # Случайная метка этого процесса (NOTIFY; имя файла метрик, если нет /proc): pid повторяются в разных контейнерах (7, 8, ...),
+    # а метку, созданную до fork, унаследовали бы все воркеры — поэтому своя после каждого fork
+    global _process_token
+    if _process_token[0] != os.getpid():
+        _process_token = (os.getpid(), uuid.uuid4().hex)
+    return _process_token[1]
+
+
+class SharedGeneration:
+    """Номер версии, общий для воркеров одной машины: bump() в одном — current() меняется у всех."""
+
+    def __init__(self, name, folder=CACHE_DIR):
+        self.path = os.path.join(folder, f"{name}.gen")
+
+    def current(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def bump(self):
+        now = time.time_ns()
+        with open(self.path, 'a'):
+            pass
+        os.utime(self.path, ns=(now, now))
+
+
+# Версии по ключу (объявление, переписка) — не файл на ключ, а GENERATION_BUCKETS файлов в своей папке:
+# файлов не прибавляется с каждым объявлением, а /metrics не листает их в CACHE_DIR. Ключи из одной
+# корзины изредка сбрасываются вместе — это лишь лишний промах кэша
+GENERATION_BUCKETS = int(os.environ.get('GENERATION_BUCKETS', 1024))
+
+for _kind in ('item', 'chat'):
+    os.makedirs(os.path.join(CACHE_DIR, f"{_kind}-gen"), exist_ok=True)
+
+def keyed_generation(kind, key):
+    bucket = int(hashlib.sha1(str(key).encode()).hexdigest()[:8], 16) % GENERATION_BUCKETS
+    return SharedGeneration(str(bucket), os.path.join(CACHE_DIR, f"{kind}-gen"))
+
+
+class TTLCache:
+    """LRU-кэш со сроком жизни записей и счетчиками попаданий."""
+
+    def __init__(self, maxsize, ttl, generation=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = generation
+        self._seen_generation = generation.current() if generation else None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        self._sync()
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, expires_at=None):
+        expires_at = min(time.time() + self.ttl, expires_at or float('inf'))
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _sync(self):
+        if self.generation is None: return
+        current = self.generation.current()
+        if current != self._seen_generation:
+            self._seen_generation = current
+            self.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0}
+
+
+class PgListener:
+    """Один поток LISTEN на воркер: раздает NOTIFY подписчикам; после переподключения зовет их с None."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def subscribe(self, channel, handler):
+        self._handlers[channel] = handler
+
+    def listening(self):
+        return self._pid == os.getpid()
+
+    def ensure(self):
+        # Поток запускаем в каждом воркере отдельно (после fork потоки не наследуются)
+        if self._pid == os.getpid() or not DB_URL: return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='pg-listener', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                conn = psycopg2.connect(DB_URL)
+                conn.autocommit = True
+                for channel in self._handlers:
+                    conn.cursor().execute(f"LISTEN {channel}")
+                for handler in self._handlers.values():
+                    handler(None)  # пока не слушали, уведомления могли пропасть
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []): continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self._handlers[notify.channel](notify.payload)
+                        except Exception as e:
+                            print(f"❌ Ошибка обработки NOTIFY {notify.channel}: {e}")
+            except Exception as e:
+                print(f"❌ LISTEN оборвался: {e}")
+                time.sleep(5)
+
+
+pg_listener = PgListener()
+
+
+# =================================================================
+# 👇 МЕТРИКИ: задержка, SQL, шаблоны, загрузка фото — /metrics для Prometheus 👇
+# =================================================================
+# Каждый воркер копит свои счетчики и раз в METRICS_DUMP_INTERVAL сек сбрасывает их
+# в CACHE_DIR/metrics-<pid>-<время старта процесса>.json; /metrics складывает файлы живых воркеров,
+# файлы умерших удаляет (их счетчики пропадают — Prometheus считает это сбросом counter).
+METRICS_DUMP_INTERVAL = float(os.environ.get('METRICS_DUMP_INTERVAL', 5))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')                      # без него /metrics закрыт (кроме debug)
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))        # 0 — лог медленных запросов выключен
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_FIELDS = ('count', 'latency', 'queries', 'db_seconds', 'rows', 'upload_seconds', 'template_seconds')
+
+_instrumented_cursors = {}
+
+def instrumented_cursor(cursor_class):
+    # Подкласс любого курсора (обычного, RealDictCursor, ...), который отчитывается в метрики запроса
+    if cursor_class not in _instrumented_cursors:
+        def execute(self, query, vars=None):
+            start = time.perf_counter()
+            try:
+                return cursor_class.execute(self, query, vars)
+            finally:
+                record_query(query, time.perf_counter() - start)
+
+        def fetchone(self):
+            row = cursor_class.fetchone(self)
+            if row is not None: record_rows(1)
+            return row
+
+        def fetchmany(self, *args, **kwargs):
+            rows = cursor_class.fetchmany(self, *args, **kwargs)
+            record_rows(len(rows))
+            return rows
+
+        def fetchall(self):
+            rows = cursor_class.fetchall(self)
+            record_rows(len(rows))
+            return rows
+
+        _instrumented_cursors[cursor_class] = type('Instrumented' + cursor_class.__name__, (cursor_class,),
+                                                   {'execute': execute, 'fetchone': fetchone,
+                                                    'fetchmany': fetchmany, 'fetchall': fetchall})
+    return _instrumented_cursors[cursor_class]
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs['cursor_factory'] = instrumented_cursor(kwargs.get('cursor_factory') or psycopg2.extensions.cursor)
+        return super().cursor(*args, **kwargs)
+
+
+def current_request_metrics():
+    return g.get('request_metrics') if has_request_context() else None
+
+def record_query(query, seconds):
+    metrics = current_request_metrics()
+    if metrics is None: return
+    metrics['queries'] += 1
+    metrics['db_seconds'] += seconds
+    if SLOW_REQUEST_MS:
+        metrics['sql'].append((seconds, str(query)))
+
+def record_rows(count):
+    metrics = current_request_metrics()
+    if metrics is not None:
+        metrics['rows'] += count
+
+@contextmanager
+def timed(field):
+    # Время в upload_seconds / template_seconds текущего запроса
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current_request_metrics()
+        if metrics is not None:
+            metrics[field] += time.perf_counter() - start
+
+
+def process_started(pid):
+    # Время старта процесса (тики с загрузки системы) из /proc: вместе с pid однозначно задает процесс,
+    # даже если pid достался другому. Без /proc (не Linux) — None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+class MetricsRegistry:
+    """Накопленные по эндпоинтам метрики одного воркера + сборка по всем воркерам."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._dumped_at = 0.0
+
+    def observe(self, endpoint, request_metrics, latency):
+        with self._lock:
+            data = self._endpoints.setdefault(endpoint, dict.fromkeys(METRIC_FIELDS, 0) | {'buckets': [0] * len(LATENCY_BUCKETS)})
+            data['count'] += 1
+            data['latency'] += latency
+            for field in ('queries', 'db_seconds', 'rows', 'upload_seconds', 'template_seconds'):
+                data[field] += request_metrics[field]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    data['buckets'][i] += 1
+        if time.time() - self._dumped_at > METRICS_DUMP_INTERVAL:
+            self.dump()
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(data, buckets=list(data['buckets'])) for endpoint, data in self._endpoints.items()}
+
+    def dump(self):
+        self._dumped_at = time.time()
+        path = os.path.join(CACHE_DIR, f"metrics-{os.getpid()}-{process_started(os.getpid()) or process_token()}.json")
+        if not os.path.exists(path):
+            # Первый сброс процесса: файл умершего процесса с тем же pid больше не нужен
+            for name in os.listdir(CACHE_DIR):
+                if name.startswith(f"metrics-{os.getpid()}-") and name.endswith('.json'):
+                    try:
+                        os.remove(os.path.join(CACHE_DIR, name))
+                    except OSError:
+                        pass
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def _stale(self, name):
+        # metrics-<pid>-<время старта>.json: процесса нет, или pid достался новому процессу (время старта другое).
+        # Без /proc в имени случайная метка — тогда проверяем только, жив ли pid
+        try:
+            pid, started = name[len('metrics-'):-len('.json')].split('-')
+            pid = int(pid)
+        except ValueError:
+            return True  # старый формат metrics-<pid>.json
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        current = process_started(pid)
+        return current is not None and current != started
+
+    def collect_all(self):
+        self.dump()
+        total = {}
+        for name in os.listdir(CACHE_DIR):
+            if not (name.startswith('metrics-') and name.endswith('.json')): continue
+            if self._stale(name):
+                try:
+                    os.remove(os.path.join(CACHE_DIR, name))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(CACHE_DIR, name)) as f:
+                    worker = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for endpoint, data in worker.items():
+                into = total.setdefault(endpoint, dict.fromkeys(METRIC_FIELDS, 0) | {'buckets': [0] * len(LATENCY_BUCKETS)})
+                for field in METRIC_FIELDS:
+                    into[field] += data[field]
+                into['buckets'] = [a + b for a, b in zip(into['buckets'], data['buckets'])]
+        return total
+
+
+metrics_registry = MetricsRegistry()
+
+@app.before_request
+def start_request_metrics():
+    g.request_metrics = {'start': time.perf_counter(), 'queries': 0, 'db_seconds': 0.0, 'rows': 0,
+                         'upload_seconds': 0.0, 'template_seconds': 0.0, 'sql': []}
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    metrics = g.pop('request_metrics', None)
+    if metrics is None: return
+    latency = time.perf_counter() - metrics['start']
+    endpoint = request.endpoint or 'unknown'
+    metrics_registry.observe(endpoint, metrics, latency)
+    if SLOW_REQUEST_MS and latency * 1000 >= SLOW_REQUEST_MS:
+        print(f"🐢 {request.method} {request.full_path} [{endpoint}] {latency * 1000:.0f} мс, "
+              f"SQL: {metrics['queries']} ({metrics['db_seconds'] * 1000:.0f} мс)")
+        for seconds, query in metrics['sql']:
+            print(f"    {seconds * 1000:7.1f} мс  {' '.join(query.split())[:300]}")
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    metrics = current_request_metrics()
+    if metrics is not None:
+        metrics['template_started'] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+    metrics = current_request_metrics()
+    if metrics is not None and 'template_started' in metrics:
+        metrics['template_seconds'] += time.perf_counter() - metrics.pop('template_started')
+
+def prometheus_text(endpoints):
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+    histogram = []
+    for endpoint, data in sorted(endpoints.items()):
+        for bound, count in zip(LATENCY_BUCKETS, data['buckets']):
+            histogram.append(f'yohkecar_request_duration_seconds_bucket{{endpoint="{label(endpoint)}",le="{bound}"}} {count}')
+        histogram.append(f'yohkecar_request_duration_seconds_bucket{{endpoint="{label(endpoint)}",le="+Inf"}} {data["count"]}')
+        histogram.append(f'yohkecar_request_duration_seconds_sum{{endpoint="{label(endpoint)}"}} {data["latency"]}')
+        histogram.append(f'yohkecar_request_duration_seconds_count{{endpoint="{label(endpoint)}"}} {data["count"]}')
+    metric('yohkecar_request_duration_seconds', 'histogram', 'Время обработки запроса', histogram)
+
+    for field, name, help_text in (('queries', 'yohkecar_db_queries_total', 'SQL-запросов'),
+                                   ('db_seconds', 'yohkecar_db_seconds_total', 'Время в SQL, сек'),
+                                   ('rows', 'yohkecar_db_rows_fetched_total', 'Строк получено из базы'),
+                                   ('upload_seconds', 'yohkecar_upload_seconds_total', 'Ожидание загрузки фото (Cloudinary), сек'),
+                                   ('template_seconds', 'yohkecar_template_seconds_total', 'Рендер шаблонов, сек')):
+        metric(name, 'counter', help_text,
+               [f'{name}{{endpoint="{label(endpoint)}"}} {data[field]}' for endpoint, data in sorted(endpoints.items())])
+
+    # Состояние этого воркера (пул, кэши) — как gauge с pid
+    pid = os.getpid()
+    if _db_pool is not None and _db_pool_pid == pid:
+        pool = _db_pool.stats()
+        metric('yohkecar_db_pool_in_use', 'gauge', 'Занятых соединений пула', [f'yohkecar_db_pool_in_use{{pid="{pid}"}} {pool["in_use"]}'])
+        metric('yohkecar_db_pool_max', 'gauge', 'Размер пула', [f'yohkecar_db_pool_max{{pid="{pid}"}} {pool["max"]}'])
+        metric('yohkecar_db_pool_wait_seconds_total', 'counter', 'Ожидание соединения из пула, сек',
+               [f'yohkecar_db_pool_wait_seconds_total{{pid="{pid}"}} {pool["wait_total"]}'])
+        metric('yohkecar_db_pool_timeouts_total', 'counter', 'Не дождались соединения',
+               [f'yohkecar_db_pool_timeouts_total{{pid="{pid}"}} {pool["timeouts"]}'])
+    caches = {'feed': feed_cache, 'item': item_cache, 'card': card_cache, 'user': user_cache, 'favorites': favorites_cache}
+    for field, help_text in (('hits', 'Попадания в кэш воркера'), ('misses', 'Промахи кэша воркера')):
+        metric(f'yohkecar_cache_{field}_total', 'counter', help_text,
+               [f'yohkecar_cache_{field}_total{{cache="{name}",pid="{pid}"}} {cache.stats()[field]}' for name, cache in caches.items()])
+    return "\n".join(lines) + "\n"
+
+# =================================================================
+# 👇 СЧЕТЧИК ПРОСМОТРОВ: копим в памяти воркера, пишем пачками 👇
+# =================================================================
+# При аварийном убийстве воркера теряется не больше VIEWS_FLUSH_INTERVAL секунд просмотров.
+VIEWS_FLUSH_INTERVAL = float(os.environ.get('VIEWS_FLUSH_INTERVAL', 10))
+VIEWS_MAX_PENDING = int(os.environ.get('VIEWS_MAX_PENDING', 1000))  # столько разных объявлений — сбрасываем досрочно
+
+
+class ViewCounter:
+    """Буфер +1 к items.views, который фоновый поток сбрасывает в базу одним UPDATE."""
+
+    def __init__(self, interval, max_pending):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retain = 0      # сколько помнить записанные пачки: не меньше срока жизни кэшей со строками items
+        self._pending = {}
+        self._flushing = {}  # уже забрано из буфера, но еще не закоммичено
+        self._flushed = []   # [(время commit, пачка)] — для строк, прочитанных из базы до этой записи
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def hit(self, item_id):
+        self._ensure_flusher()
+        with self._lock:
+            self._pending[item_id] = self._pending.get(item_id, 0) + 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def pending(self, item_id, read_at=None):
+        # read_at — когда строку прочитали из базы (строка из кэша): записанное позже в ней еще не учтено
+        count = self._pending.get(item_id, 0) + self._flushing.get(item_id, 0)
+        if read_at is not None:
+            count += sum(batch.get(item_id, 0) for flushed_at, batch in self._flushed if flushed_at > read_at)
+        return count
+
+    def pending_total(self):
+        with self._lock:
+            return sum(self._pending.values()) + sum(self._flushing.values())
+
+    def apply(self, items):
+        # Подмешиваем еще не записанные просмотры, чтобы счетчик на странице не "отставал".
+        # У строк из кэша (views_read_at) — и записанные после чтения, иначе после flush счетчик уменьшится
+        for item in items:
+            item['views'] = (item['views'] or 0) + self.pending(item['id'], item.get('views_read_at'))
+        return items
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+        if not batch: return 0
+        try:
+            with app.app_context():
+                conn = get_db_connection()
+                if not conn: raise RuntimeError("нет соединения с базой")
+                execute_values(conn.cursor(), """UPDATE items SET views = views + d.delta
+                                                 FROM (VALUES %s) AS d(id, delta) WHERE items.id = d.id""",
+                               list(batch.items()))
+                bump_site_stat(conn.cursor(), 'views', sum(batch.values()))
+                conn.commit()
+        except Exception as e:
+            print(f"❌ Не удалось записать просмотры: {e}")
+            with self._lock:
+                for item_id, delta in batch.items():
+                    self._pending[item_id] = self._pending.get(item_id, 0) + delta
+                self._flushing = {}
+            return 0
+        now = time.time()
+        with self._lock:
+            self._flushing = {}
+            self._flushed = [(t, b) for t, b in self._flushed if t > now - self.retain] + [(now, batch)]
+        return len(batch)
+
+    def _ensure_flusher(self):
+        # Поток запускаем в каждом воркере отдельно (после fork потоки не наследуются)
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._pid = os.getpid()
+            self._pending = {}
+            threading.Thread(target=self._run, name='view-counter', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+view_counter = ViewCounter(VIEWS_FLUSH_INTERVAL, VIEWS_MAX_PENDING)
+atexit.register(view_counter.flush)
 
+# =================================================================
+# 👇 МИГРАЦИИ СХЕМЫ: запускаются один раз при деплое, а не в каждом воркере 👇
+# =================================================================
+#   flask --app main migrate            — применить недостающие
+#   flask --app main migrate --status   — показать, что применено
+# Новая миграция = новая функция в конце MIGRATIONS. Уже примененные не редактировать.
+# Обычная миграция — одна транзакция. Миграции с заполнением данных (RESUMABLE_MIGRATIONS) коммитят пачками:
+# их DDL идемпотентен (IF NOT EXISTS), а заполнение берет только необработанные строки, так что после сбоя
+# повторный migrate продолжает с места обрыва. В schema_migrations они попадают только после последней пачки.
+
+def migration_base_schema(cursor):
     cursor.execute('''CREATE TABLE IF NOT EXISTS users 
                       (login text PRIMARY KEY, 
                        password text, 
@@ -87,164 +754,2141 @@ def init_db():
     cursor.execute('''CREATE TABLE IF NOT EXISTS favorites 
                       (user_login text, item_id INTEGER)''')
 
-    conn.commit()
-    conn.close()
+def migration_feed_and_search(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_vip_expiry_idx ON items (vip_expiry)")
+    cursor.execute("ALTER TABLE items ADD COLUMN IF NOT EXISTS image_variants jsonb")
+
+    # Поиск: нормализованный текст (синонимы + транслит) и взвешенный tsvector
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    cursor.execute("ALTER TABLE items ADD COLUMN IF NOT EXISTS search_text text")
+    cursor.execute("ALTER TABLE items ADD COLUMN IF NOT EXISTS search_vector tsvector")
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_search_vector_idx ON items USING GIN (search_vector)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_search_text_trgm_idx ON items USING GIN (search_text gin_trgm_ops)")
+    # reindex коммитит пачками; если упадет, повторный migrate продолжит с непроиндексированных
+    reindex_search(cursor)
+
+def migration_seller_stats(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS seller_stats 
+                      (seller_login text PRIMARY KEY, review_count INTEGER NOT NULL DEFAULT 0, star_sum INTEGER NOT NULL DEFAULT 0)''')
+    rebuild_seller_stats(cursor)
+
+def migration_hot_path_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_owner_login_created_at_idx ON items (owner_login, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_created_at_idx ON items (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS reviews_item_id_idx ON reviews (item_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS messages_sender_receiver_idx ON messages (sender, receiver, id)")
+    # Перед уникальностью убираем дубли, которые мог наплодить старый toggle_fav
+    cursor.execute("""DELETE FROM favorites a USING favorites b
+                      WHERE a.ctid < b.ctid AND a.user_login = b.user_login AND a.item_id = b.item_id""")
+    cursor.execute("ALTER TABLE favorites ADD CONSTRAINT favorites_user_item_key UNIQUE (user_login, item_id)")
+
+def migration_conversations(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS conversations 
+                      (user_login text PRIMARY KEY, last_message_id INTEGER NOT NULL, last_date text, last_sender text,
+                       preview text, unread_count INTEGER NOT NULL DEFAULT 0)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS conversations_last_message_id_idx ON conversations (last_message_id DESC)")
+    # Старые переписки: последнее сообщение каждой, непрочитанные неизвестны — считаем 0
+    sync_conversations(cursor)
+
+def migration_site_stats(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS site_stats (name text PRIMARY KEY, value BIGINT NOT NULL DEFAULT 0)")
+    refresh_site_stats(cursor)
+    # Список пользователей в админке: сортировка по роли и поиск по подстроке
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_role_idx ON users (is_admin DESC, is_moderator DESC, login)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_login_trgm_idx ON users USING GIN (login gin_trgm_ops)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_nickname_trgm_idx ON users USING GIN (nickname gin_trgm_ops)")
+
+def migration_price_amount(cursor):
+    cursor.execute("ALTER TABLE items ADD COLUMN IF NOT EXISTS price_amount numeric(14, 2)")
+    cursor.execute("ALTER TABLE items ADD COLUMN IF NOT EXISTS price_currency text")
+    # Индексы под ORDER BY ленты: дешевле/дороже, без цены — в конце
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_price_asc_idx ON items (price_amount ASC NULLS LAST, id DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_price_desc_idx ON items (price_amount DESC NULLS LAST, id DESC)")
+    cursor.connection.commit()
+    # backfill коммитит пачками; если упадет, повторный migrate продолжит с неразобранных
+    # updated_at появится только в миграции 9 (и заполнится из created_at)
+    backfill_prices(cursor, touch_updated_at=False)
+
+def migration_legacy_import(cursor):
+    # Прогресс импорта старых SQLite-баз (import-legacy) и соответствие старых id объявлений новым
+    cursor.execute('''CREATE TABLE IF NOT EXISTS legacy_imports 
+                      (source text, table_name text, last_rowid BIGINT NOT NULL DEFAULT 0, rows_imported BIGINT NOT NULL DEFAULT 0,
+                       done BOOLEAN NOT NULL DEFAULT false, PRIMARY KEY (source, table_name))''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS legacy_item_ids 
+                      (source text, old_id INTEGER, new_id INTEGER NOT NULL, PRIMARY KEY (source, old_id))''')
+
+def migration_items_updated_at(cursor):
+    # Время последней правки объявления (текст, фото, VIP) — для выгрузок "изменилось после"
+    cursor.execute("ALTER TABLE items ADD COLUMN IF NOT EXISTS updated_at DOUBLE PRECISION")
+    cursor.execute("UPDATE items SET updated_at = created_at WHERE updated_at IS NULL")
+    cursor.execute("ALTER TABLE items ALTER COLUMN updated_at SET DEFAULT extract(epoch FROM now())")
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_updated_at_idx ON items (updated_at, id)")
+
+def migration_favorites_key(cursor):
+    # Уникальность (user_login, item_id) уже есть (миграция 4) — делаем ее первичным ключом,
+    # а избранное удаленных объявлений удаляется вместе с ними
+    cursor.execute("""DELETE FROM favorites f WHERE user_login IS NULL OR item_id IS NULL
+                          OR NOT EXISTS (SELECT 1 FROM items WHERE items.id = f.item_id)""")
+    cursor.execute("ALTER TABLE favorites ALTER COLUMN user_login SET NOT NULL, ALTER COLUMN item_id SET NOT NULL")
+    cursor.execute("ALTER TABLE favorites DROP CONSTRAINT IF EXISTS favorites_user_item_key")
+    cursor.execute("ALTER TABLE favorites ADD PRIMARY KEY (user_login, item_id)")
+    cursor.execute("""ALTER TABLE favorites ADD CONSTRAINT favorites_item_fkey
+                      FOREIGN KEY (item_id) REFERENCES items (id) ON DELETE CASCADE""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS favorites_item_id_idx ON favorites (item_id)")
+
+def migration_archive_tables(cursor):
+    # Холодные таблицы для archive-stale: те же колонки, что у горячих, без их индексов поиска и ленты.
+    # Новая колонка items должна добавляться и в items_archive (той же миграцией).
+    cursor.execute("CREATE TABLE IF NOT EXISTS items_archive (LIKE items, archived_at DOUBLE PRECISION NOT NULL, PRIMARY KEY (id))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS items_archive_owner_login_idx ON items_archive (owner_login, id)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS reviews_archive (LIKE reviews, PRIMARY KEY (id))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS reviews_archive_item_id_idx ON reviews_archive (item_id)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS favorites_archive (LIKE favorites, PRIMARY KEY (user_login, item_id))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS favorites_archive_item_id_idx ON favorites_archive (item_id)")
+
+def migration_legacy_logins(cursor):
+    # Логины из старых SQLite-баз: занятые переименованы, см. legacy_logins
+    cursor.execute('''CREATE TABLE IF NOT EXISTS legacy_logins 
+                      (source text, old_login text, new_login text NOT NULL, PRIMARY KEY (source, old_login))''')
+
+def migration_deleted_items(cursor):
+    # Удаленные и архивные объявления для выгрузок ?since= — партнер должен узнать, что их больше нет
+    cursor.execute('''CREATE TABLE IF NOT EXISTS deleted_items 
+                      (id INTEGER PRIMARY KEY, deleted_at DOUBLE PRECISION NOT NULL, reason text NOT NULL)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS deleted_items_deleted_at_idx ON deleted_items (deleted_at, id)")
+
+MIGRATIONS = [
+    (1, 'base schema', migration_base_schema),
+    (2, 'feed, search and image columns', migration_feed_and_search),
+    (3, 'seller_stats', migration_seller_stats),
+    (4, 'hot path indexes, unique favorites', migration_hot_path_indexes),
+    (5, 'conversations', migration_conversations),
+    (6, 'site_stats, admin user list indexes', migration_site_stats),
+    (7, 'numeric price_amount, price_currency', migration_price_amount),
+    (8, 'legacy sqlite import bookkeeping', migration_legacy_import),
+    (9, 'items.updated_at for delta exports', migration_items_updated_at),
+    (10, 'favorites primary key, cascade on item delete', migration_favorites_key),
+    (11, 'cold tables for archived listings', migration_archive_tables),
+    (12, 'legacy login mapping', migration_legacy_logins),
+    (13, 'deleted_items tombstones for delta exports', migration_deleted_items),
+]
+RESUMABLE_MIGRATIONS = {2, 7}  # reindex_search, backfill_prices
+MIGRATIONS_LOCK_ID = 7204001  # pg_advisory_lock: два деплоя не мигрируют одновременно
+
+def applied_migrations(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations
+                      (version INTEGER PRIMARY KEY, name text, applied_at DOUBLE PRECISION)""")
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row['version'] for row in cursor.fetchall()}
+
+def migrate(conn):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+    try:
+        done = applied_migrations(cursor)
+        conn.commit()
+        applied = []
+        for version, name, apply in MIGRATIONS:
+            if version in done: continue
+            # Обычная миграция — своя транзакция: упала — откатилась целиком, следующий запуск повторит.
+            # RESUMABLE_MIGRATIONS коммитят по ходу: упала — следующий запуск продолжит, а не начнет заново
+            if version in RESUMABLE_MIGRATIONS:
+                print(f"⏳ {version:03d} {name}: заполняется пачками, при сбое запустите migrate снова")
+            apply(cursor)
+            cursor.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)",
+                           (version, name, time.time()))
+            conn.commit()
+            applied.append((version, name))
+        return applied
+    finally:
+        conn.rollback()
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+        conn.commit()
 
-init_db()
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help='Только показать примененные и ожидающие миграции')
+def migrate_command(status):
+    """Применяет миграции схемы (запускать при деплое)."""
+    conn = get_db_connection()
+    if not conn: raise SystemExit(1)
+    if status:
+        done = applied_migrations(conn.cursor(cursor_factory=RealDictCursor))
+        conn.commit()
+        for version, name, _ in MIGRATIONS:
+            print(f"{'✅' if version in done else '⏳'} {version:03d} {name}")
+        return
+    for version, name in migrate(conn):
+        print(f"✅ {version:03d} {name}")
+    print("Схема актуальна")
 
-def get_seller_rating(seller_login):
+# =================================================================
+# 👇 РЕЙТИНГ ПРОДАВЦА: готовые суммы в seller_stats 👇
+# =================================================================
+# Счетчики обновляются в add_review и delete_item; пересчитать с нуля:
+#   flask --app main rebuild-seller-stats   /   flask --app main check-seller-stats
+SELLER_STATS_FROM_REVIEWS_SQL = """SELECT items.owner_login AS seller_login, count(*) AS review_count,
+                                          COALESCE(sum(reviews.stars), 0) AS star_sum
+                                   FROM reviews JOIN items ON items.id = reviews.item_id
+                                   GROUP BY items.owner_login"""
+
+def add_seller_review(cursor, item_id, stars):
+    cursor.execute("""INSERT INTO seller_stats (seller_login, review_count, star_sum)
+                      SELECT owner_login, 1, %s FROM items WHERE id = %s
+                      ON CONFLICT (seller_login) DO UPDATE
+                      SET review_count = seller_stats.review_count + 1,
+                          star_sum = seller_stats.star_sum + EXCLUDED.star_sum""", (stars, item_id))
+
+def remove_item_reviews_from_stats(cursor, item_id, seller_login):
+    # Отзывы удаленного объявления больше не учитываются в рейтинге продавца
+    cursor.execute("""UPDATE seller_stats
+                      SET review_count = seller_stats.review_count - r.cnt,
+                          star_sum = seller_stats.star_sum - r.stars
+                      FROM (SELECT count(*) AS cnt, COALESCE(sum(stars), 0) AS stars
+                            FROM reviews WHERE item_id = %s) r
+                      WHERE seller_stats.seller_login = %s AND r.cnt > 0""", (item_id, seller_login))
+
+def rebuild_seller_stats(cursor):
+    cursor.execute("DELETE FROM seller_stats")
+    cursor.execute(f"INSERT INTO seller_stats (seller_login, review_count, star_sum) {SELLER_STATS_FROM_REVIEWS_SQL}")
+
+def seller_stats_mismatches(cursor):
+    cursor.execute(f"""SELECT COALESCE(s.seller_login, r.seller_login) AS seller_login,
+                              s.review_count AS stored_count, s.star_sum AS stored_sum,
+                              r.review_count AS actual_count, r.star_sum AS actual_sum
+                       FROM seller_stats s FULL OUTER JOIN ({SELLER_STATS_FROM_REVIEWS_SQL}) r
+                            ON r.seller_login = s.seller_login
+                       WHERE COALESCE(s.review_count, 0) <> COALESCE(r.review_count, 0)
+                          OR COALESCE(s.star_sum, 0) <> COALESCE(r.star_sum, 0)""")
+    return cursor.fetchall()
+
+@app.cli.command('rebuild-seller-stats')
+def rebuild_seller_stats_command():
+    """Пересчитывает seller_stats по таблице reviews."""
     conn = get_db_connection()
-    if not conn: return 0, 0
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT id FROM items WHERE owner_login = %s", (seller_login,))
-    items = cursor.fetchall()
+    if not conn: return
+    rebuild_seller_stats(conn.cursor())
+    conn.commit()
+    print("✅ Рейтинги продавцов пересчитаны")
 
-    if not items:
-        conn.close()
-        return 0, 0
-
-    total_stars = 0
-    count = 0
-    for item in items:
-        cursor.execute("SELECT stars FROM reviews WHERE item_id = %s", (item['id'],))
-        reviews = cursor.fetchall()
-        for review in reviews:
-            total_stars += review['stars']
-            count += 1
-    conn.close()
-    if count == 0: return 0, 0
-    return round(total_stars / count, 1), count
+@app.cli.command('check-seller-stats')
+def check_seller_stats_command():
+    """Сверяет seller_stats с таблицей reviews."""
+    conn = get_db_connection()
+    if not conn: return
+    mismatches = seller_stats_mismatches(conn.cursor(cursor_factory=RealDictCursor))
+    for row in mismatches:
+        print(f"❌ {row['seller_login']}: в seller_stats {row['stored_count']}/{row['stored_sum']}, "
+              f"по отзывам {row['actual_count']}/{row['actual_sum']}")
+    if mismatches:
+        raise SystemExit(1)
+    print("✅ seller_stats совпадает с отзывами")
+
+# =================================================================
+# 👇 СТАТИСТИКА САЙТА: счетчики в site_stats вместо count(*)/sum() 👇
+# =================================================================
+# Обновляются вместе с записью (регистрация, создание/удаление, сброс просмотров).
+# Пересчет с нуля (можно по расписанию): flask --app main refresh-site-stats
+SITE_STATS_TTL = float(os.environ.get('SITE_STATS_TTL', 30))
+ADMIN_USERS_PAGE_SIZE = 50
+site_stats_cache = TTLCache(1, SITE_STATS_TTL)
+
+def bump_site_stat(cursor, name, delta):
+    if delta:
+        cursor.execute("UPDATE site_stats SET value = value + %s WHERE name = %s", (delta, name))
+
+def refresh_site_stats(cursor):
+    cursor.execute("""INSERT INTO site_stats (name, value) VALUES
+                          ('users', (SELECT count(*) FROM users)),
+                          ('items', (SELECT count(*) FROM items)),
+                          ('views', (SELECT COALESCE(sum(views), 0) FROM items))
+                      ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value""")
+
+def get_site_stats(cursor):
+    stats = site_stats_cache.get('stats')
+    if stats is None:
+        cursor.execute("SELECT name, value FROM site_stats")
+        stats = {row['name']: row['value'] for row in cursor.fetchall()}
+        site_stats_cache.set('stats', stats)
+    return stats
+
+@app.cli.command('refresh-site-stats')
+def refresh_site_stats_command():
+    """Пересчитывает site_stats по таблицам users и items."""
+    conn = get_db_connection()
+    if not conn: return
+    refresh_site_stats(conn.cursor())
+    conn.commit()
+    print("✅ Статистика сайта пересчитана")
+
+SEARCH_SYNONYMS = {
+    'bmw': 'бмв', 'бмв': 'bmw', 'mercedes': 'мерседес', 'мерседес': 'mercedes', 'benz': 'бенц',
+    'audi': 'ауди', 'ауди': 'audi', 'vw': 'фольксваген', 'volkswagen': 'фольксваген', 'фольксваген': 'vw',
+    'toyota': 'тойота', 'тойота': 'toyota', 'lexus': 'лексус', 'лексус': 'lexus',
+    'kia': 'киа', 'киа': 'kia', 'hyundai': 'хендай', 'хендай': 'hyundai',
+    'ford': 'форд', 'форд': 'ford', 'mazda': 'мазда', 'мазда': 'mazda',
+    'honda': 'хонда', 'хонда': 'honda', 'nissan': 'ниссан', 'ниссан': 'nissan',
+    'tesla': 'тесла', 'тесла': 'tesla', 'chevrolet': 'шевроле', 'шевроле': 'chevrolet',
+    'porsche': 'порш', 'порш': 'porsche', 'skoda': 'шкода', 'шкода': 'skoda',
+    'volvo': 'вольво', 'вольво': 'volvo'
+}
+LATIN_TO_CYRILLIC = str.maketrans("abcehkmoptxy", "авсенкмортху")
 
 def get_search_variants(query):
     query = query.lower().strip()
     variants = {query}
-    synonyms = {
-        'bmw': 'бмв', 'бмв': 'bmw', 'mercedes': 'мерседес', 'мерседес': 'mercedes', 'benz': 'бенц',
-        'audi': 'ауди', 'ауди': 'audi', 'vw': 'фольксваген', 'volkswagen': 'фольксваген', 'фольксваген': 'vw',
-        'toyota': 'тойота', 'тойота': 'toyota', 'lexus': 'лексус', 'лексус': 'lexus',
-        'kia': 'киа', 'киа': 'kia', 'hyundai': 'хендай', 'хендай': 'hyundai',
-        'ford': 'форд', 'форд': 'ford', 'mazda': 'мазда', 'мазда': 'mazda',
-        'honda': 'хонда', 'хонда': 'honda', 'nissan': 'ниссан', 'ниссан': 'nissan',
-        'tesla': 'тесла', 'тесла': 'tesla', 'chevrolet': 'шевроле', 'шевроле': 'chevrolet',
-        'porsche': 'порш', 'порш': 'porsche', 'skoda': 'шкода', 'шкода': 'skoda',
-        'volvo': 'вольво', 'вольво': 'volvo'
-    }
     words = query.split()
     translated_words = []
     for word in words:
-        if word in synonyms:
-            translated_words.append(synonyms[word])
+        if word in SEARCH_SYNONYMS:
+            translated_words.append(SEARCH_SYNONYMS[word])
         else:
-            table = str.maketrans("abcehkmoptxy", "авсенкмортху")
-            translated_words.append(word.translate(table))
+            translated_words.append(word.translate(LATIN_TO_CYRILLIC))
     variants.add(" ".join(translated_words))
     for w in translated_words:
         variants.add(w)
     return list(variants)
 
+# =================================================================
+# 👇 ПОИСКОВЫЙ ИНДЕКС (tsvector + pg_trgm) 👇
+# =================================================================
+# Синонимы марок и латиница->кириллица применяются при индексации:
+# в документ "BMW X5" попадают "bmw бмв x5 х5", поэтому "bmw" и "бмв" находят одно и то же.
+SEARCH_VECTOR_SQL = ("setweight(to_tsvector('simple', %s), 'A') || "
+                     "setweight(to_tsvector('simple', %s), 'B') || "
+                     "setweight(to_tsvector('simple', %s), 'C')")
+
+def expand_search_words(text):
+    words = []
+    for word in re.findall(r'\w+', (text or '').lower()):
+        # Как в get_search_variants: синоним марки, а если его нет — латиница, похожая на кириллицу
+        for variant in (word, SEARCH_SYNONYMS.get(word) or word.translate(LATIN_TO_CYRILLIC)):
+            if variant and variant not in words:
+                words.append(variant)
+    return " ".join(words)
+
+def search_index_values(title, city, description):
+    # (search_text, заголовок, город, описание) — параметры для search_text и SEARCH_VECTOR_SQL
+    title_doc = expand_search_words(title)
+    city_doc = expand_search_words(city)
+    description_doc = expand_search_words(description)
+    return (f"{title_doc} {city_doc}".strip(), title_doc, city_doc, description_doc)
+
+def search_query_sql(search_query):
+    # Префиксный полнотекстовый поиск + подстрока по триграммному индексу, с релевантностью
+    words = expand_search_words(search_query).split()
+    if not words: return None
+    tsquery = " | ".join(f"{w}:*" for w in words)
+    where = "(search_vector @@ to_tsquery('simple', %s)" + "".join(
+        " OR search_text ILIKE %s" for w in words if len(w) >= 3) + ")"
+    params = [tsquery] + [f"%{w}%" for w in words if len(w) >= 3]
+    order = "ts_rank(search_vector, to_tsquery('simple', %s)) + similarity(search_text, %s) DESC, id DESC"
+    return where, params, order, [tsquery, search_query.lower()]
+
+def reindex_search(cursor, batch_size=500, only_missing=True):
+    last_id = 0
+    done = 0
+    while True:
+        cursor.execute(f"""SELECT id, title, city, description FROM items WHERE id > %s
+                           {'AND search_vector IS NULL' if only_missing else ''}
+                           ORDER BY id LIMIT %s""", (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows: return done
+        for row in rows:
+            cursor.execute(f"UPDATE items SET search_text = %s, search_vector = {SEARCH_VECTOR_SQL} WHERE id = %s",
+                           search_index_values(row['title'], row['city'], row['description']) + (row['id'],))
+        cursor.connection.commit()
+        last_id = rows[-1]['id']
+        done += len(rows)
+
+@app.cli.command('reindex-search')
+@click.option('--all', 'reindex_all', is_flag=True, help='Переиндексировать все объявления, а не только новые')
+def reindex_search_command(reindex_all):
+    """Заполняет search_text/search_vector для объявлений."""
+    conn = get_db_connection()
+    if not conn: return
+    done = reindex_search(conn.cursor(cursor_factory=RealDictCursor), only_missing=not reindex_all)
+    print(f"✅ Проиндексировано объявлений: {done}")
 
-# --- ROUTES ---
-@app.route('/')
-def home():
-    if 'user' in session:
-        current_user_login = session['user']
-        current_user_name = session.get('nickname')
-        user_is_admin = session.get('is_admin')
-    else:
-        current_user_login = None
-        current_user_name = None
-        user_is_admin = 0
-
-    page = request.args.get('page', 1, type=int)
-    search_query = request.args.get('q', '')
-    category_filter = request.args.get('cat', '')
-    country_filter = request.args.get('country', '')
+# =================================================================
+# 👇 ПОДСКАЗКИ ПОИСКА: префиксный индекс в памяти воркера 👇
+# =================================================================
+# Фразы (заголовки, города, марки) с числом объявлений; ключи — в нижнем регистре, плюс вариант
+# с синонимами/кириллицей, как в expand_search_words: "мерс" и "merc" находят "Mercedes E200".
+# Изменения объявлений приходят всем воркерам через NOTIFY suggest; раз в SUGGEST_REBUILD_EVERY — полная пересборка.
+SUGGEST_CHANNEL = 'suggest'
+SUGGEST_MAX_PHRASES = int(os.environ.get('SUGGEST_MAX_PHRASES', 50000))
+SUGGEST_REBUILD_EVERY = float(os.environ.get('SUGGEST_REBUILD_EVERY', 3600))
+SUGGEST_MIN_PREFIX = 2
+SUGGEST_LIMIT = 8
+SUGGEST_SCAN = 400       # сколько ключей с нужным префиксом просматриваем, не больше
+SUGGEST_PHRASE_LENGTH = 60
+SUGGEST_BRANDS = {latin: latin.upper() if len(latin) <= 3 else latin.capitalize()
+                  for latin in SEARCH_SYNONYMS if latin.isascii()}
+
+
+def suggest_words(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+def suggest_keys(phrase):
+    # Ключи фразы: с начала и с каждого из следующих двух слов, как написано и в "поисковом" написании
+    words = suggest_words(phrase)[:8]
+    translated = [SEARCH_SYNONYMS.get(w) or w.translate(LATIN_TO_CYRILLIC) for w in words]
+    keys = set()
+    for start in range(min(len(words), 3)):
+        keys.add(" ".join(words[start:]))
+        keys.add(" ".join(translated[start:]))
+    return keys
+
+def listing_phrases(title, city):
+    # (вид, текст) для одного объявления: заголовок, город и марки из заголовка
+    phrases = []
+    title = " ".join((title or '').split())[:SUGGEST_PHRASE_LENGTH]
+    if title: phrases.append(('title', title))
+    city = " ".join((city or '').split())[:SUGGEST_PHRASE_LENGTH]
+    if city: phrases.append(('city', city))
+    words = set(suggest_words(title))
+    for latin, display in SUGGEST_BRANDS.items():
+        if latin in words or SEARCH_SYNONYMS[latin] in words:
+            phrases.append(('brand', display))
+    return phrases
+
+
+class SuggestIndex:
+    """Префиксный индекс: отсортированный список (ключ, фраза) + bisect; счетчики по фразам."""
+
+    def __init__(self, max_phrases):
+        self.max_phrases = max_phrases
+        self._lock = threading.Lock()
+        self._counts = {}   # (вид, текст в нижнем регистре) -> [текст, счетчик]
+        self._keys = []     # отсортированные (ключ, (вид, текст в нижнем регистре))
+        self._results = TTLCache(1024, 60)
+        self._built_at = None
+        self._building = False
+        self._during_rebuild = None  # пока идет пересборка — изменения из NOTIFY, их повторим на новом индексе
+        self.rebuilds = 0
+
+    def _add(self, counts, keys, kind, text, delta):
+        phrase = (kind, text.lower())
+        entry = counts.get(phrase)
+        if entry is None:
+            if delta <= 0: return
+            entry = counts[phrase] = [text, 0]
+            for key in suggest_keys(text):
+                bisect.insort(keys, (key, phrase))
+        entry[1] += delta
+        if entry[1] <= 0:
+            del counts[phrase]
+            for key in suggest_keys(text):
+                i = bisect.bisect_left(keys, (key, phrase))
+                if i < len(keys) and keys[i] == (key, phrase):
+                    del keys[i]
+
+    def apply(self, removed=(), added=()):
+        with self._lock:
+            for kind, text in removed:
+                self._add(self._counts, self._keys, kind, text, -1)
+            for kind, text in added:
+                self._add(self._counts, self._keys, kind, text, 1)
+            if len(self._counts) > self.max_phrases * 1.1:
+                self._prune(self._counts, self._keys)
+            if self._during_rebuild is not None:
+                self._during_rebuild.append((removed, added))
+        self._results.clear()
+
+    def _prune(self, counts, keys):
+        # Память ограничена: оставляем max_phrases самых частых фраз
+        keep = set(sorted(counts, key=lambda phrase: counts[phrase][1], reverse=True)[:self.max_phrases])
+        for phrase in [phrase for phrase in counts if phrase not in keep]:
+            del counts[phrase]
+        keys[:] = [entry for entry in keys if entry[1] in keep]
+
+    def rebuild(self):
+        # Полная пересборка в фоне, потоково по таблице items; поиск отвечает по старому индексу.
+        # Изменения, пришедшие во время чтения, копим с момента до снимка таблицы и повторяем на новом индексе
+        # (то, что успело попасть и в снимок, может учесться дважды — это поправит следующая пересборка)
+        counts, keys = {}, []
+        with self._lock:
+            self._during_rebuild = []
+        try:
+            self._scan(counts)
+        except Exception:
+            with self._lock:
+                self._during_rebuild = None
+            raise
+        if len(counts) > self.max_phrases:
+            self._prune(counts, [])
+        keys = sorted((key, phrase) for phrase, (text, _) in counts.items() for key in suggest_keys(text))
+        with self._lock:
+            for removed, added in self._during_rebuild:
+                for kind, text in removed:
+                    self._add(counts, keys, kind, text, -1)
+                for kind, text in added:
+                    self._add(counts, keys, kind, text, 1)
+            self._during_rebuild = None
+            self._counts, self._keys = counts, keys
+            self._built_at = time.time()
+            self.rebuilds += 1
+        self._results.clear()
+
+    def _scan(self, counts):
+        with app.app_context():
+            conn = get_db_connection()
+            if not conn: raise RuntimeError("нет соединения с базой")
+            cursor = conn.cursor(name='suggest_rebuild', cursor_factory=RealDictCursor)
+            cursor.execute("SELECT title, city FROM items")
+            while True:
+                rows = cursor.fetchmany(5000)
+                if not rows: break
+                for row in rows:
+                    for kind, text in listing_phrases(row['title'], row['city']):
+                        phrase = (kind, text.lower())
+                        if phrase in counts: counts[phrase][1] += 1
+                        else: counts[phrase] = [text, 1]
+            cursor.close()
+            conn.rollback()
+
+    def invalidate(self):
+        self._built_at = None
+
+    def _ensure_built(self):
+        pg_listener.ensure()
+        if self._built_at is not None and time.time() - self._built_at < SUGGEST_REBUILD_EVERY: return
+        with self._lock:
+            if self._building: return
+            self._building = True
+
+        def run():
+            try:
+                self.rebuild()
+            except Exception as e:
+                print(f"❌ Не удалось собрать подсказки: {e}")
+            finally:
+                self._building = False
+        get_executor('background', 2).submit(run)
+
+    def suggest(self, query, limit=SUGGEST_LIMIT):
+        self._ensure_built()
+        prefix = " ".join(suggest_words(query))
+        if len(prefix) < SUGGEST_MIN_PREFIX: return []
+        cached = self._results.get((prefix, limit))
+        if cached is not None: return cached
+        found = {}
+        with self._lock:
+            for variant in {prefix, prefix.translate(LATIN_TO_CYRILLIC)}:
+                i = bisect.bisect_left(self._keys, (variant,))
+                for key, phrase in self._keys[i:i + SUGGEST_SCAN]:
+                    if not key.startswith(variant): break
+                    if phrase in self._counts:
+                        found[phrase] = self._counts[phrase]
+        ranked = sorted(found.items(), key=lambda item: (-item[1][1], len(item[1][0])))
+        result = [{'text': text, 'kind': kind, 'count': count} for (kind, _), (text, count) in ranked[:limit]]
+        self._results.set((prefix, limit), result)
+        return result
+
+    def stats(self):
+        return {'phrases': len(self._counts), 'keys': len(self._keys), 'built_at': self._built_at,
+                'rebuilds': self.rebuilds, 'cache': self._results.stats()}
+
+
+suggest_index = SuggestIndex(SUGGEST_MAX_PHRASES)
+
+def on_suggest_notify(payload):
+    if payload is None or payload == 'rebuild':
+        suggest_index.invalidate()
+        return
+    change = json.loads(payload)
+    suggest_index.apply([tuple(p) for p in change.get('removed', [])], [tuple(p) for p in change.get('added', [])])
+
+pg_listener.subscribe(SUGGEST_CHANNEL, on_suggest_notify)
+
+def notify_suggest_changed(cursor, old=None, new=None):
+    # old/new — (title, city) до и после; вызывать до commit, применится во всех воркерах, включая этот
+    removed = listing_phrases(*old) if old else []
+    added = listing_phrases(*new) if new else []
+    if removed == added: return
+    cursor.execute("SELECT pg_notify(%s, %s)", (SUGGEST_CHANNEL, json.dumps({'removed': removed, 'added': added}, ensure_ascii=False)))
 
+# =================================================================
+# 👇 ЦЕНА: число + валюта из текста объявления, фильтр и сортировка по индексу 👇
+# =================================================================
+PRICE_DEFAULT_CURRENCY = 'EUR'  # сайт показывает цены в евро
+PRICE_MAX = Decimal('1e12')      # numeric(14, 2)
+PRICE_NUMBER_RE = re.compile(r'\d[\d\s.,]*')
+PRICE_MULTIPLIER_RE = re.compile(r'\s*(тыс|млн|к|k)(?!\w)')
+PRICE_MULTIPLIERS = {'тыс': 1000, 'к': 1000, 'k': 1000, 'млн': 1000000}
+PRICE_CURRENCIES = [
+    ('EUR', ('€', 'eur', 'евро')),
+    ('USD', ('$', 'usd', 'долл')),
+    ('RUB', ('₽', 'руб', 'rub')),
+    ('GBP', ('£', 'gbp', 'фунт')),
+    ('CHF', ('chf',)),
+    ('CZK', ('kč', 'czk')),
+    ('PLN', ('zł', 'pln', 'злот')),
+    ('SEK', ('sek',)),
+]
+PRICE_SYMBOLS = {'EUR': '€', 'USD': '$', 'RUB': '₽', 'GBP': '£'}
+
+def parse_price(text):
+    # "15 000", "1,5к €", "200$", "Договорная" -> (Decimal('15000.00'), 'EUR') / (None, None)
+    if not text: return None, None
+    lowered = str(text).lower()
+    match = PRICE_NUMBER_RE.search(lowered)
+    if not match: return None, None
+    number = re.sub(r'\s', '', match.group(0)).strip('.,')
+    if ',' in number and '.' in number:
+        # Последний из разделителей — дробная часть, второй — разряды
+        thousands = ',' if number.rfind('.') > number.rfind(',') else '.'
+        number = number.replace(thousands, '').replace(',', '.')
+    else:
+        for sep in ',.':
+            parts = number.split(sep)
+            if len(parts) > 2 or (len(parts) == 2 and len(parts[1]) == 3):
+                number = number.replace(sep, '')  # "1.500.000", "15,000" — разряды
+            else:
+                number = number.replace(sep, '.')
+    try:
+        amount = Decimal(number)
+    except InvalidOperation:
+        return None, None
+    multiplier = PRICE_MULTIPLIER_RE.match(lowered, match.end())
+    if multiplier:
+        amount *= PRICE_MULTIPLIERS[multiplier.group(1)]
+    amount = amount.quantize(Decimal('0.01'))
+    if amount >= PRICE_MAX: return None, None
+    currency = next((code for code, marks in PRICE_CURRENCIES if any(mark in lowered for mark in marks)), PRICE_DEFAULT_CURRENCY)
+    return amount, currency
+
+def price_values(text):
+    # Значения для колонок (price_amount, price_currency); '' — цену не распознали, повторно не разбирать
+    amount, currency = parse_price(text)
+    return amount, currency or ''
+
+def price_label(item):
+    # Для шаблонов: "15 000 €"; нераспознанную цену ("Договорная") показываем как есть
+    amount = item.get('price_amount')
+    if amount is None:
+        return item.get('price') or ''
+    amount = Decimal(amount)
+    text = f"{amount:,.2f}" if amount % 1 else f"{amount:,.0f}"
+    return f"{text.replace(',', ' ').replace('.', ',')} {PRICE_SYMBOLS.get(item.get('price_currency'), item.get('price_currency') or '')}".strip()
+
+app.jinja_env.globals.update(price_label=price_label)
+
+def backfill_prices(cursor, batch_size=1000, only_missing=True, touch_updated_at=True):
+    last_id = 0
+    done = 0
+    while True:
+        cursor.execute(f"""SELECT id, price FROM items WHERE id > %s
+                           {'AND price_currency IS NULL' if only_missing else ''}
+                           ORDER BY id LIMIT %s""", (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows: return done
+        values = [(row['id'], *price_values(row['price'])) for row in rows]
+        # updated_at — только у изменившихся: по нему обновляются карточки ленты и выгрузки ?since=
+        touch = ", updated_at = extract(epoch FROM now())" if touch_updated_at else ""
+        execute_values(cursor, f"""UPDATE items SET price_amount = v.amount, price_currency = v.currency{touch}
+                                  FROM (VALUES %s) AS v (id, amount, currency)
+                                  WHERE items.id = v.id AND (items.price_amount IS DISTINCT FROM v.amount
+                                                             OR items.price_currency IS DISTINCT FROM v.currency)""",
+                       values, template="(%s, %s::numeric, %s)")
+        cursor.connection.commit()
+        last_id = rows[-1]['id']
+        done += len(rows)
+
+@app.cli.command('backfill-prices')
+@click.option('--all', 'backfill_all', is_flag=True, help='Пересчитать все цены, а не только еще не разобранные')
+def backfill_prices_command(backfill_all):
+    """Разбирает текстовые цены в price_amount/price_currency."""
     conn = get_db_connection()
-    if not conn: return "Ошибка подключения к базе данных"
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    done = backfill_prices(conn.cursor(cursor_factory=RealDictCursor), only_missing=not backfill_all)
+    print(f"✅ Цены разобраны: {done}")
 
-    liked_ids = []
-    if current_user_login:
-        cursor.execute("SELECT item_id FROM favorites WHERE user_login = %s", (current_user_login,))
-        likes = cursor.fetchall()
-        liked_ids = [row['item_id'] for row in likes]
+# =================================================================
+# 👇 ЛЕНТА: фильтры, VIP через каждые 5 обычных, пагинация в базе 👇
+# =================================================================
+FEED_PAGE_SIZE = 15
+FEED_VIP_EVERY = 5
 
-    sql = "SELECT * FROM items WHERE 1=1"
+FEED_SORTS = {
+    'price_asc': "price_amount ASC NULLS LAST, id DESC",
+    'price_desc': "price_amount DESC NULLS LAST, id DESC",
+}
+
+def build_feed_filters(search_query, category_filter, country_filter, min_price=None, max_price=None, sort=None):
+    # Возвращает (where, params, order, order_params); order=None значит "id DESC" с keyset-курсором
+    where = ["1=1"]
     params = []
+    order, order_params = None, []
 
     if search_query:
-        variants = get_search_variants(search_query)
-        search_conditions = []
-        for v in variants:
-            search_conditions.append("title ILIKE %s")
-            search_conditions.append("city ILIKE %s")
-            params.append(f"%{v}%")
-            params.append(f"%{v}%")
-        if search_conditions:
-            sql += " AND (" + " OR ".join(search_conditions) + ")"
+        search = search_query_sql(search_query)
+        if search:
+            search_where, search_params, order, order_params = search
+            where.append(search_where)
+            params.extend(search_params)
 
     if category_filter and category_filter != 'Все':
-        sql += " AND category = %s"
+        where.append("category = %s")
         params.append(category_filter)
 
     if country_filter:
-        sql += " AND region = %s"
+        where.append("region = %s")
         params.append(country_filter)
 
-    sql += " ORDER BY id DESC"
+    if min_price is not None:
+        where.append("price_amount >= %s")
+        params.append(min_price)
+
+    if max_price is not None:
+        where.append("price_amount <= %s")
+        params.append(max_price)
+
+    if sort in FEED_SORTS:
+        # Явная сортировка по цене важнее релевантности поиска
+        order, order_params = FEED_SORTS[sort], []
+
+    return " AND ".join(where), params, order, order_params
+
+def feed_slots(offset, limit, regular_total, vip_total):
+    # Раскладка ленты: после каждых 5 обычных идет VIP, пока VIP не кончатся;
+    # хвост обычных, затем оставшиеся VIP. Возвращает [('r', номер) | ('v', номер), ...]
+    block = FEED_VIP_EVERY + 1
+    mixed = min(vip_total, regular_total // FEED_VIP_EVERY)
+    tail_regulars = regular_total - FEED_VIP_EVERY * mixed
+    slots = []
+    for pos in range(max(offset, 0), min(offset + limit, regular_total + vip_total)):
+        if pos < block * mixed:
+            j, r = divmod(pos, block)
+            slots.append(('r', FEED_VIP_EVERY * j + r) if r < FEED_VIP_EVERY else ('v', j))
+        elif pos - block * mixed < tail_regulars:
+            slots.append(('r', FEED_VIP_EVERY * mixed + pos - block * mixed))
+        else:
+            slots.append(('v', mixed + pos - block * mixed - tail_regulars))
+    return slots
+
+def feed_cursor_signature(body, scope):
+    # Подпись курсора: id от клиента без нее не принимаем. Подписаны только позиция и фильтры ленты (scope):
+    # новые и удаленные объявления keyset переживает, так что обычные правки курсор не ломают
+    message = f"{body}|{scope}".encode()
+    return hmac.new((app.secret_key or '').encode(), message, hashlib.sha256).hexdigest()[:16]
+
+def vip_fingerprint(vip_ids):
+    # Версия состава VIP, одинаковая во всех воркерах: от нее зависит раскладка страниц
+    return hashlib.sha1(','.join(map(str, vip_ids)).encode()).hexdigest()[:8]
+
+def parse_feed_cursor(raw, page, scope='', vip_ids=()):
+    # Курсор "страница.последний_обычный_id.последний_vip_id.версия_vip.подпись" действует только для своей
+    # страницы и пока не поменялся состав VIP — иначе страница считается через OFFSET
+    try:
+        cursor_page, last_regular, last_vip, vips, signature = (raw or '').split('.')
+        if int(cursor_page) != page: return None
+        if not hmac.compare_digest(signature, feed_cursor_signature(f"{cursor_page}.{last_regular}.{last_vip}.{vips}", scope)): return None
+        if vips != vip_fingerprint(vip_ids): return None
+        return {'r': int(last_regular) if last_regular else None, 'v': int(last_vip) if last_vip else None}
+    except ValueError:
+        return None
+
+# Активные VIP держим в памяти воркера: (id, vip_expiry), по id DESC — как их показывает лента.
+# Перечитываются, когда истекает ближайший VIP, и по NOTIFY vip_roster от make_vip/remove_vip в любом воркере.
+VIP_ROSTER_CHANNEL = 'vip_roster'
+VIP_ROSTER_MAX_AGE = float(os.environ.get('VIP_ROSTER_MAX_AGE', 60))  # страховка, если LISTEN отвалился
+
+
+class VipRoster:
+    """Список активных VIP-объявлений воркера, обновляемый по сроку и по NOTIFY."""
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._entries = []
+        self._loaded_at = 0.0
+        self._next_expiry = None
+        self._version = 0         # растет при каждом invalidate()
+        self._loaded_version = -1
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+
+    def _fresh(self, now):
+        return (self._loaded_version == self._version and now - self._loaded_at < self.max_age
+                and (self._next_expiry is None or now < self._next_expiry))
+
+    def entries(self, cursor):
+        pg_listener.ensure()
+        now = time.time()
+        if self._fresh(now): return self._entries
+        with self._lock:
+            if self._fresh(now): return self._entries
+            version = self._version
+        # Читаем без блокировки: invalidate() во время чтения оставит список устаревшим до следующего запроса
+        cursor.execute("SELECT id, vip_expiry FROM items WHERE vip_expiry > %s ORDER BY id DESC", (now,))
+        entries = [(row['id'], row['vip_expiry']) for row in cursor.fetchall()]
+        with self._lock:
+            self._entries = entries
+            self._next_expiry = min((expiry for _, expiry in entries), default=None)
+            self._loaded_at = now
+            self._loaded_version = version
+            self.reloads += 1
+        return entries
+
+    def ids(self, cursor):
+        now = time.time()
+        return [item_id for item_id, expiry in self.entries(cursor) if expiry > now]
+
+    def next_expiry(self, cursor):
+        self.entries(cursor)
+        return self._next_expiry
+
+    def stats(self):
+        return {'size': len(self._entries), 'next_expiry': self._next_expiry, 'reloads': self.reloads,
+                'listening': pg_listener.listening()}
+
+
+vip_roster = VipRoster(VIP_ROSTER_MAX_AGE)
+pg_listener.subscribe(VIP_ROSTER_CHANNEL, lambda payload: vip_roster.invalidate())
+
+def notify_vip_changed(cursor):
+    # Вызывать до commit: NOTIFY доставляется всем воркерам только если транзакция прошла
+    cursor.execute(f"NOTIFY {VIP_ROSTER_CHANNEL}")
+
+def fetch_feed_page(cursor, where, params, page, after=None, order=None, order_params=(), scope=''):
+    # Курсор экономит только OFFSET выборки строк. count(*) по тем же фильтрам (ради total_pages и раскладки VIP)
+    # выполняется на каждой странице и растет с числом подходящих объявлений — глубокие страницы не бесплатны.
+    vip_ids = vip_roster.ids(cursor)
+    cursor.execute(f"""SELECT count(*) FILTER (WHERE id = ANY(%s)) AS vips,
+                              count(*) FILTER (WHERE NOT id = ANY(%s)) AS regulars
+                       FROM items WHERE {where}""", [vip_ids, vip_ids] + params)
+    counts = cursor.fetchone()
+    total_pages = math.ceil((counts['vips'] + counts['regulars']) / FEED_PAGE_SIZE)
+    if page < 1: return [], total_pages, None
+
+    slots = feed_slots((page - 1) * FEED_PAGE_SIZE, FEED_PAGE_SIZE, counts['regulars'], counts['vips'])
+    after = after or {}
+    rows = {}
+    for kind, condition in (('r', "NOT id = ANY(%s)"), ('v', "id = ANY(%s)")):
+        wanted = [i for k, i in slots if k == kind]
+        if not wanted: continue
+        sql = f"SELECT * FROM items WHERE {where} AND {condition}"
+        args = params + [vip_ids]
+        if order is None and after.get(kind) is not None:
+            # Keyset: продолжаем сразу после последней показанной строки, без OFFSET
+            sql += " AND id < %s"
+            args.append(after[kind])
+            offset = 0
+        else:
+            offset = wanted[0]
+        sql += f" ORDER BY {order or 'id DESC'} LIMIT %s OFFSET %s"
+        read_at = time.time()
+        cursor.execute(sql, args + list(order_params) + [len(wanted), offset])
+        rows[kind] = iter([dict(row, views_read_at=read_at) for row in cursor.fetchall()])
+
+    items = []
+    last = dict(after)
+    for kind, _ in slots:
+        item = next(rows[kind], None)
+        if item is None: continue  # строку удалили между count и выборкой
+        items.append(item)
+        last[kind] = item['id']
+    if order is not None: return items, total_pages, None
+    body = f"{page + 1}.{last.get('r') or ''}.{last.get('v') or ''}.{vip_fingerprint(vip_ids)}"
+    return items, total_pages, f"{body}.{feed_cursor_signature(body, scope)}"
+
+# Кэш ленты по (page, q, cat, country, цена, sort): данные страницы + готовый HTML для гостей.
+# Сбрасывается при изменении объявлений (listing_changed) и когда истекает ближайший VIP.
+FEED_CACHE_TTL = float(os.environ.get('FEED_CACHE_TTL', 30))
+FEED_CACHE_SIZE = int(os.environ.get('FEED_CACHE_SIZE', 256))
+feed_generation = SharedGeneration('feed')
+feed_cache = TTLCache(FEED_CACHE_SIZE, FEED_CACHE_TTL, feed_generation)
+
+def next_vip_change(cursor):
+    # Когда истечет ближайший VIP — раскладка всех страниц ленты поменяется
+    return vip_roster.next_expiry(cursor)
+
+# Кэш страницы объявления: товар + отзывы + рейтинг продавца одним запросом.
+# У каждого объявления своя метка (item_generation): правка одного не сбрасывает кэш остальных.
+ITEM_CACHE_TTL = float(os.environ.get('ITEM_CACHE_TTL', 10))
+ITEM_CACHE_SIZE = int(os.environ.get('ITEM_CACHE_SIZE', 1024))
+item_cache = TTLCache(ITEM_CACHE_SIZE, ITEM_CACHE_TTL)
+view_counter.retain = max(FEED_CACHE_TTL, ITEM_CACHE_TTL)  # строки items живут в этих кэшах
+
+ITEM_PAGE_SQL = """SELECT i.*,
+                          COALESCE((SELECT json_agg(r ORDER BY r.id DESC) FROM reviews r WHERE r.item_id = i.id), '[]') AS page_reviews,
+                          s.review_count AS seller_review_count, s.star_sum AS seller_star_sum
+                   FROM items i LEFT JOIN seller_stats s ON s.seller_login = i.owner_login
+                   WHERE i.id = %s"""
+
+# Архивное объявление открывается по прямой ссылке: то же самое из холодных таблиц
+ARCHIVED_ITEM_PAGE_SQL = """SELECT i.*,
+                                   COALESCE((SELECT json_agg(r ORDER BY r.id DESC) FROM reviews_archive r WHERE r.item_id = i.id), '[]') AS page_reviews,
+                                   s.review_count AS seller_review_count, s.star_sum AS seller_star_sum
+                            FROM items_archive i LEFT JOIN seller_stats s ON s.seller_login = i.owner_login
+                            WHERE i.id = %s"""
+
+def item_generation(item_id):
+    return keyed_generation('item', item_id)
+
+def seller_rating(review_count, star_sum):
+    if not review_count or review_count <= 0: return 0, 0
+    return round(star_sum / review_count, 1), review_count
+
+def get_item_page(cursor, item_id, user_login):
+    # -> (item, reviews, (rating, reviews_count), is_liked) или None; is_liked — из множества избранного пользователя.
+    # У архивного объявления в item есть archived_at
+    stamp = item_generation(item_id).current()
+    cached = item_cache.get(item_id)
+    if cached and cached[0] == stamp:
+        _, item, reviews, rating = cached
+    else:
+        read_at = time.time()
+        cursor.execute(ITEM_PAGE_SQL, (item_id,))
+        item = cursor.fetchone()
+        if not item:
+            cursor.execute(ARCHIVED_ITEM_PAGE_SQL, (item_id,))
+            item = cursor.fetchone()
+        if not item: return None
+        item = dict(item, views_read_at=read_at)  # для view_counter.apply: строка пойдет в кэш
+        reviews = item.pop('page_reviews')
+        rating = seller_rating(item.pop('seller_review_count'), item.pop('seller_star_sum'))
+        item_cache.set(item_id, (stamp, item, reviews, rating))
+    is_liked = bool(user_login) and item_id in user_favorites(cursor, user_login)
+    return item, reviews, rating, is_liked
+
+def listing_changed(item_id=None):
+    # Вызывать после commit любой записи, меняющей объявления
+    feed_generation.bump()
+    if item_id is not None:
+        item_generation(item_id).bump()
 
-    cursor.execute(sql, tuple(params))
-    all_items = cursor.fetchall()
-    conn.close()
+# =================================================================
+# 👇 ЗАГРУЗКА ФОТО: параллельно, при желании в фоне 👇
+# =================================================================
+# IMAGE_STORAGE=cloudinary|local (local кладет файлы в static/uploads — для тестов и замеров без сети)
+# IMAGE_UPLOAD_ASYNC=1 — объявление сохраняется сразу с заглушкой, фото догружаются в фоне
+IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE') or ('cloudinary' if os.environ.get('CLOUDINARY_CLOUD_NAME') else 'local')
+if not os.environ.get('IMAGE_STORAGE') and IMAGE_STORAGE == 'local':
+    # На хостинге с временным диском фото пропадут при следующем деплое — пусть это будет видно в логах
+    print(f"⚠️ CLOUDINARY_CLOUD_NAME не задан: фото сохраняются на локальный диск ({UPLOAD_FOLDER}). Задайте IMAGE_STORAGE=local явно, если так и задумано")
+IMAGE_UPLOAD_THREADS = int(os.environ.get('IMAGE_UPLOAD_THREADS', 5))
+IMAGE_UPLOAD_ASYNC = os.environ.get('IMAGE_UPLOAD_ASYNC') == '1'
+NO_PHOTO_URL = "https://placehold.co/400x300/EEE/31343C?text=Нет+фото"
+PENDING_PHOTO_URL = "https://placehold.co/400x300/EEE/31343C?text=Фото+загружается"
+# Фото фоновой загрузки лежат здесь, пока не уйдут в хранилище (не в static — наружу не отдаются)
+PENDING_UPLOADS_DIR = os.environ.get('PENDING_UPLOADS_DIR', os.path.join(CACHE_DIR, 'pending-uploads'))
+os.makedirs(PENDING_UPLOADS_DIR, exist_ok=True)
+# Расширение файла выбираем сами по содержимому: имя от клиента (evil.html, evil.svg) не используем
+LOCAL_IMAGE_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'GIF': 'gif'}
+
+
+# Варианты для шаблонов: (ширина, высота, обрезать до квадрата); в 2 раза больше CSS-размера под retina
+IMAGE_VARIANTS = {
+    'thumb': (180, 180, True),    # миниатюры 30px в ленте и 90px на странице товара
+    'card': (320, 320, True),     # карточка 160px в ленте / 120px в избранном
+    'detail': (1280, 960, False), # большое фото на странице товара
+}
+
+
+class CloudinaryStorage:
+    def save(self, filename, data):
+        return cloudinary.uploader.upload(io.BytesIO(data))['secure_url']
+
+    def variants(self, url, data=None):
+        # Cloudinary сам режет по трансформации в URL — загружать ничего не нужно
+        if '/upload/' not in url: return None
+        result = {}
+        for size, (width, height, crop) in IMAGE_VARIANTS.items():
+            mode = 'c_fill' if crop else 'c_limit'
+            result[size] = {fmt: url.replace('/upload/', f'/upload/{mode},w_{width},h_{height},q_auto,f_{fmt}/', 1)
+                            for fmt in ('webp', 'jpg')}
+        return result
+
+
+class LocalStorage:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def save(self, filename, data):
+        if Image is None:
+            raise ValueError("для локального хранилища нужен Pillow")
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.verify()
+        except Exception:
+            raise ValueError(f"{filename}: не картинка")
+        if image.format not in LOCAL_IMAGE_FORMATS:
+            raise ValueError(f"{filename}: формат {image.format} не поддерживается")
+        stem = os.path.splitext(secure_filename(filename))[0] or 'photo'
+        name = f"{int(time.time())}_{uuid.uuid4().hex[:8]}_{stem}.{LOCAL_IMAGE_FORMATS[image.format]}"
+        with open(os.path.join(self.folder, name), 'wb') as f:
+            f.write(data)
+        return f"/{self.folder}/{name}"
+
+    def variants(self, url, data=None):
+        if Image is None: return None
+        base = os.path.splitext(os.path.basename(url))[0]
+        if data is None:
+            with open(os.path.join(self.folder, os.path.basename(url)), 'rb') as f:
+                data = f.read()
+        original = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('RGB')
+        result = {}
+        for size, (width, height, crop) in IMAGE_VARIANTS.items():
+            if crop:
+                image = ImageOps.fit(original, (width, height))
+            else:
+                image = original.copy()
+                image.thumbnail((width, height))
+            result[size] = {}
+            for fmt, pil_format, options in (('webp', 'WEBP', {'quality': 80}), ('jpg', 'JPEG', {'quality': 82, 'progressive': True})):
+                name = f"{base}_{size}.{fmt}"
+                image.save(os.path.join(self.folder, name), pil_format, **options)
+                result[size][fmt] = f"/{self.folder}/{name}"
+        return result
+
+
+IMAGE_STORAGES = {
+    'cloudinary': lambda: CloudinaryStorage(),
+    'local': lambda: LocalStorage(UPLOAD_FOLDER),
+}
+image_storage = IMAGE_STORAGES[IMAGE_STORAGE]()
+
+_executors = {}
+_executors_pid = None
+
+def get_executor(name, workers):
+    # Как и пул БД — свои потоки в каждом воркере, после fork потоки старого процесса не работают
+    global _executors_pid
+    if _executors_pid != os.getpid():
+        _executors.clear()
+        _executors_pid = os.getpid()
+    if name not in _executors:
+        _executors[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+    return _executors[name]
+
+def read_uploaded_images(files, count=5):
+    # Файлы запроса читаем сразу: после ответа поток запроса уже закрыт
+    images = []
+    for i in range(1, count + 1):
+        file = files.get(f'image{i}')
+        images.append((file.filename, file.read()) if file and file.filename != '' else None)
+    return images
+
+def store_image(filename, data):
+    url = image_storage.save(filename, data)
+    try:
+        variants = image_storage.variants(url, data)
+    except Exception as e:
+        print(f"Ошибка нарезки превью: {e}")
+        variants = None
+    return url, variants
+
+def upload_images(images):
+    # Все фото уходят в хранилище одновременно; упавшая загрузка дает "" как раньше.
+    # Возвращает (urls, variants) — по 5 элементов, variants[i] = {'card': {'webp':..., 'jpg':...}, ...} или None
+    futures = [get_executor('upload', IMAGE_UPLOAD_THREADS).submit(store_image, *image) if image else None for image in images]
+    urls = []
+    variants = []
+    with timed('upload_seconds'):
+        for future in futures:
+            url, image_variants = "", None
+            if future is not None:
+                try:
+                    url, image_variants = future.result()
+                except Exception as e:
+                    print(f"Ошибка загрузки фото: {e}")
+            urls.append(url)
+            variants.append(image_variants)
+    if urls and urls[0] == "": urls[0] = NO_PHOTO_URL
+    return urls, variants
+
+def spool_item_images(item_id, images):
+    # До ответа кладем фото на диск: если воркер перезапустится посреди загрузки,
+    # finish-pending-images догрузит их отсюда, и заглушка "Фото загружается" не останется навсегда
+    folder = os.path.join(PENDING_UPLOADS_DIR, str(item_id))
+    os.makedirs(folder, exist_ok=True)
+    for slot, image in enumerate(images, 1):
+        if image:
+            with open(os.path.join(folder, f"{slot}_{secure_filename(image[0]) or 'photo'}"), 'wb') as f:
+                f.write(image[1])
+
+def spooled_item_images(item_id):
+    folder = os.path.join(PENDING_UPLOADS_DIR, str(item_id))
+    images = [None] * 5
+    for name in os.listdir(folder):
+        slot, _, filename = name.partition('_')
+        with open(os.path.join(folder, name), 'rb') as f:
+            images[int(slot) - 1] = (filename, f.read())
+    return images
+
+def finish_item_images(item_id, images):
+    # Фоновая стадия: догружаем фото и подменяем заглушки в image1..image5
+    urls, variants = upload_images(images)
+    with app.app_context():
+        conn = get_db_connection()
+        if not conn: return
+        cursor = conn.cursor()
+        cursor.execute("UPDATE items SET image1=%s, image2=%s, image3=%s, image4=%s, image5=%s, image_variants=%s, updated_at=%s WHERE id=%s",
+                       (*urls, Json(variants), time.time(), item_id))
+        conn.commit()
+    shutil.rmtree(os.path.join(PENDING_UPLOADS_DIR, str(item_id)), ignore_errors=True)
+    listing_changed(item_id)
+
+@app.cli.command('finish-pending-images')
+@click.option('--older-than', default=600, show_default=True, help='Секунд: более свежие загрузки, возможно, еще идут в воркере')
+def finish_pending_images_command(older_than):
+    """Догружает фото, брошенные перезапущенным воркером; заглушки без файлов заменяет на "Нет фото"."""
+    cutoff = time.time() - older_than
+    finished = 0
+    for name in os.listdir(PENDING_UPLOADS_DIR):
+        if not name.isdigit() or os.path.getmtime(os.path.join(PENDING_UPLOADS_DIR, name)) > cutoff: continue
+        finish_item_images(int(name), spooled_item_images(int(name)))
+        finished += 1
+    conn = get_db_connection()
+    if not conn: raise SystemExit(1)
+    cursor = conn.cursor()
+    # Файлов нет (диск пропал вместе с контейнером) — фото уже не вернуть, убираем вечную заглушку
+    cursor.execute("""SELECT id FROM items WHERE %s IN (image1, image2, image3, image4, image5) AND created_at < %s""",
+                   (PENDING_PHOTO_URL, cutoff))
+    lost = [row[0] for row in cursor.fetchall() if not os.path.isdir(os.path.join(PENDING_UPLOADS_DIR, str(row[0])))]
+    if lost:
+        slots = ', '.join(f"image{slot} = CASE WHEN image{slot} = %(pending)s THEN %(empty{slot})s ELSE image{slot} END" for slot in range(1, 6))
+        cursor.execute(f"UPDATE items SET {slots}, updated_at = %(now)s WHERE id = ANY(%(ids)s)",
+                       {'pending': PENDING_PHOTO_URL, 'now': time.time(), 'ids': lost,
+                        **{f'empty{slot}': NO_PHOTO_URL if slot == 1 else '' for slot in range(1, 6)}})
+        conn.commit()
+    for item_id in lost:
+        listing_changed(item_id)
+    print(f"✅ Догружено объявлений: {finished}, без фото осталось: {len(lost)}")
+
+def existing_image_variants(url):
+    # Для уже загруженных фото: Cloudinary — по URL, локальные — читаем файл; заглушки пропускаем
+    if not url: return None
+    if 'res.cloudinary.com' in url:
+        return CloudinaryStorage().variants(url)
+    if url.startswith(f"/{UPLOAD_FOLDER}/"):
+        return LocalStorage(UPLOAD_FOLDER).variants(url)
+    return None
+
+@app.cli.command('backfill-image-variants')
+@click.option('--batch-size', default=100, help='Сколько объявлений обрабатывать за раз')
+def backfill_image_variants_command(batch_size):
+    """Нарезает превью для объявлений без image_variants."""
+    conn = get_db_connection()
+    if not conn: return
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    last_id = 0
+    done = 0
+    while True:
+        cursor.execute("""SELECT id, image1, image2, image3, image4, image5 FROM items
+                          WHERE id > %s AND image_variants IS NULL ORDER BY id LIMIT %s""", (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows: break
+        for row in rows:
+            variants = []
+            for slot in range(1, 6):
+                try:
+                    variants.append(existing_image_variants(row[f'image{slot}']))
+                except Exception as e:
+                    print(f"❌ Объявление {row['id']}, фото {slot}: {e}")
+                    variants.append(None)
+            # updated_at — карточка ленты (card_fragment) и выгрузки ?since= увидят новые превью
+            cursor.execute("UPDATE items SET image_variants = %s, updated_at = %s WHERE id = %s", (Json(variants), time.time(), row['id']))
+        conn.commit()
+        last_id = rows[-1]['id']
+        done += len(rows)
+        print(f"… обработано {done}")
+    print(f"✅ Превью готовы для {done} объявлений")
+
+def image_variant(item, slot, size):
+    # {'webp': url, 'jpg': url} или None, если превью нет (старое объявление, заглушка)
+    variants = item.get('image_variants') or []
+    if slot > len(variants) or not variants[slot - 1]: return None
+    return variants[slot - 1].get(size)
+
+def item_picture(item, slot=1, size='card', css_class='', **attrs):
+    # <picture> с WebP и JPEG-запасным вариантом; без превью — обычный <img> с оригиналом
+    original = item.get(f'image{slot}')
+    if not original: return Markup('')
+    variant = image_variant(item, slot, size)
+    extra = ''.join(f' {name.replace("_", "-")}="{escape(value)}"' for name, value in attrs.items())
+    img = f'<img src="{escape(variant["jpg"] if variant else original)}" class="{escape(css_class)}"{extra}>'
+    if not variant: return Markup(img)
+    return Markup(f'<picture><source type="image/webp" srcset="{escape(variant["webp"])}">{img}</picture>')
+
+app.jinja_env.globals.update(image_variant=image_variant, item_picture=item_picture)
+
+def pending_image_urls(images):
+    urls = [PENDING_PHOTO_URL if image else "" for image in images]
+    if urls[0] == "": urls[0] = PENDING_PHOTO_URL if any(images) else NO_PHOTO_URL
+    return urls
 
-    vips = []
-    regulars = []
-    current_time = time.time()
+# =================================================================
+# 👇 ШАБЛОНЫ И СТАТИКА: байткод Jinja на диске, кэш карточек, CSS с хэшем в имени 👇
+# =================================================================
+# Скомпилированные шаблоны переживают рестарт: воркер грузит байткод из CACHE_DIR, а не парсит HTML заново
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.path.join(CACHE_DIR, 'jinja'))
+os.makedirs(app.jinja_env.bytecode_cache.directory, exist_ok=True)
+
+def warm_templates():
+    # Компилируем все шаблоны при старте, чтобы первый запрос к странице не платил за это
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        try:
+            app.jinja_env.get_template(name)
+        except Exception as e:
+            print(f"❌ Шаблон {name} не скомпилировался: {e}")
+
+# Неизменная часть карточки ленты (фото, заголовок, цена, описание) по версии объявления:
+# updated_at меняется при любой правке, VIP-метка — по сроку, поэтому оба в ключе
+CARD_CACHE_TTL = float(os.environ.get('CARD_CACHE_TTL', 3600))
+CARD_CACHE_SIZE = int(os.environ.get('CARD_CACHE_SIZE', 4096))
+card_cache = TTLCache(CARD_CACHE_SIZE, CARD_CACHE_TTL)
+
+def card_fragment(item, part):
+    vip = item['vip_expiry'] > time.time()
+    key = (item['id'], item.get('updated_at'), vip, part)
+    html = card_cache.get(key)
+    if html is None:
+        macros = app.jinja_env.get_template('_item_card.html').module
+        html = Markup(macros.gallery(item) if part == 'gallery' else macros.info(item, vip))
+        card_cache.set(key, html)
+    return html
+
+# CSS из static/css отдаем как /assets/css/<имя>.<хэш>.css: имя меняется вместе с содержимым,
+# поэтому браузер может хранить файл год и не переспрашивать. gzip/brotli готовим один раз при старте.
+ASSET_DIRS = ('css',)
+ASSET_MAX_AGE = 31536000
+ASSET_TYPES = {'.css': 'text/css; charset=utf-8', '.js': 'application/javascript; charset=utf-8'}
+UPLOADS_MAX_AGE = int(os.environ.get('UPLOADS_MAX_AGE', ASSET_MAX_AGE))
+
+
+class AssetManifest:
+    """Исходное имя -> имя с хэшем; для каждого файла держит в памяти сырые, gzip и brotli байты."""
+
+    def __init__(self, root, dirs):
+        self.urls = {}
+        self.files = {}
+        for folder in dirs:
+            base = os.path.join(root, folder)
+            if not os.path.isdir(base): continue
+            for filename in sorted(os.listdir(base)):
+                path = os.path.join(base, filename)
+                if os.path.isfile(path):
+                    self._add(f"{folder}/{filename}", path)
+
+    def _add(self, name, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        hashed = f"{stem}.{digest}{ext}"
+        variants = {'identity': data, 'gzip': gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(data, quality=11)
+        self.urls[name] = f"/assets/{hashed}"
+        self.files[hashed] = (digest, ASSET_TYPES.get(ext, 'application/octet-stream'), variants)
+
+    def url(self, name):
+        # Файла нет в манифесте (добавили без рестарта) — отдаем как обычную статику
+        return self.urls.get(name) or f"/static/{name}"
+
+    def stats(self):
+        return {name: {encoding: len(data) for encoding, data in self.files[url[len('/assets/'):]][2].items()}
+                for name, url in self.urls.items()}
+
+
+asset_manifest = AssetManifest(app.static_folder, ASSET_DIRS)
+app.jinja_env.globals.update(card_fragment=card_fragment, asset_url=asset_manifest.url)
+warm_templates()
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    entry = asset_manifest.files.get(filename)
+    if entry is None: return "Не найдено", 404
+    digest, mimetype, variants = entry
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in variants and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    response = Response(variants[encoding], mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    response.set_etag(f"{digest}-{encoding}")
+    return response.make_conditional(request)
+
+@app.after_request
+def cache_uploads(response):
+    # Имена загруженных фото уникальны (время + имя), содержимое по адресу не меняется
+    if request.path.startswith(f"/{UPLOAD_FOLDER}/") and response.status_code in (200, 304):
+        response.cache_control.public = True
+        response.cache_control.max_age = UPLOADS_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
 
-    for item in all_items:
-        if item['vip_expiry'] > current_time:
-            vips.append(item)
-        else:
-            regulars.append(item)
-
-    final_items = []
-    vip_index = 0
-    for i, item in enumerate(regulars):
-        final_items.append(item)
-        if (i + 1) % 5 == 0:
-            if vip_index < len(vips):
-                final_items.append(vips[vip_index])
-                vip_index += 1
-    while vip_index < len(vips):
-        final_items.append(vips[vip_index])
-        vip_index += 1
-    if not regulars and vips:
-        final_items = vips
-
-    LIMIT = 15
-    total_items = len(final_items)
-    total_pages = math.ceil(total_items / LIMIT)
-    offset = (page - 1) * LIMIT
-    items_to_show = final_items[offset : offset + LIMIT]
-
-    return render_template('index.html', user_login=current_user_login, user_name=current_user_name, is_admin=user_is_admin, items=items_to_show, search_query=search_query, category_filter=category_filter, page=page, total_pages=total_pages, time=time, liked_ids=liked_ids)
+# =================================================================
+# 👇 ЧАТ ПОДДЕРЖКИ: только новые сообщения, long-poll, старые — страницами 👇
+# =================================================================
+CHAT_PAGE_SIZE = int(os.environ.get('CHAT_PAGE_SIZE', 50))
+CHAT_LONGPOLL_MAX = float(os.environ.get('CHAT_LONGPOLL_MAX', 25))  # дольше прокси могут оборвать соединение
+CHAT_LONGPOLL_STEP = 0.5
+# Каждое ожидание занимает поток gunicorn (gthread) целиком. Ждут одновременно не больше CHAT_LONGPOLL_SLOTS
+# на воркер, остальным сразу пустой ответ с retry — клиент повторит позже. --threads в Procfile должен быть
+# заметно больше, чтобы обычным страницам всегда оставались свободные потоки.
+CHAT_LONGPOLL_SLOTS = int(os.environ.get('CHAT_LONGPOLL_SLOTS', 4))
+CHAT_LONGPOLL_RETRY = 5  # через сколько секунд клиенту спросить снова, если мест нет
+chat_wait_slots = threading.BoundedSemaphore(CHAT_LONGPOLL_SLOTS)
+
+def chat_generation(user_login):
+    # Отметка "в переписке с user_login что-то новое" — ждем ее без запросов к базе
+    return keyed_generation('chat', user_login)
+
+def conversation_messages(cursor, user_login, after_id=None, before_id=None, limit=CHAT_PAGE_SIZE):
+    # after_id — новые сообщения по порядку; иначе последние limit штук (до before_id), тоже по порядку
+    sql = """SELECT id, sender, receiver, text, date FROM messages
+             WHERE ((sender = %s AND receiver = 'admin') OR (sender = 'admin' AND receiver = %s))"""
+    params = [user_login, user_login]
+    if after_id is not None:
+        cursor.execute(sql + " AND id > %s ORDER BY id ASC LIMIT %s", params + [after_id, limit])
+        return cursor.fetchall()
+    if before_id is not None:
+        sql += " AND id < %s"
+        params.append(before_id)
+    cursor.execute(sql + " ORDER BY id DESC LIMIT %s", params + [limit])
+    return cursor.fetchall()[::-1]
+
+def wait_for_chat(user_login, timeout, seen):
+    # Long-poll: спим до нового сообщения или таймаута, соединение из пула не держим.
+    # seen — версия, прочитанная ДО запроса сообщений: иначе сообщение, записанное между запросом
+    # и началом ожидания, ждало бы до конца таймаута
+    generation = chat_generation(user_login)
+    deadline = time.time() + min(max(timeout, 0), CHAT_LONGPOLL_MAX)
+    while time.time() < deadline:
+        time.sleep(CHAT_LONGPOLL_STEP)
+        if generation.current() != seen:
+            return True
+    return False
+
+def chat_messages_response(user_login, mark_read=False):
+    # mark_read — переписку открыл модератор: новые сообщения, дошедшие до него, уже прочитаны
+    after_id = request.args.get('after', type=int)
+    before_id = request.args.get('before', type=int)
+    conn = get_db_connection()
+    if not conn: return jsonify(error="db"), 503
+    seen = chat_generation(user_login).current()
+    messages = conversation_messages(conn.cursor(cursor_factory=RealDictCursor), user_login, after_id, before_id)
+    wait = request.args.get('wait', 0, type=float)
+    if after_id is not None and not messages and wait > 0:
+        if not chat_wait_slots.acquire(blocking=False):
+            return jsonify(messages=[], has_more=False, retry=CHAT_LONGPOLL_RETRY)
+        try:
+            # Соединение отдаем на время ожидания, потом берем заново
+            release_db_connection(None)
+            changed = wait_for_chat(user_login, wait, seen)
+        finally:
+            chat_wait_slots.release()
+        if changed:
+            conn = get_db_connection()
+            if not conn: return jsonify(error="db"), 503
+            messages = conversation_messages(conn.cursor(cursor_factory=RealDictCursor), user_login, after_id)
+    if mark_read and after_id is not None and messages:
+        conn.cursor().execute("UPDATE conversations SET unread_count = 0 WHERE user_login = %s AND unread_count > 0", (user_login,))
+        conn.commit()
+    return jsonify(messages=messages, has_more=before_id is not None and len(messages) == CHAT_PAGE_SIZE)
+
+# Входящие модератора: одна строка на переписку, обновляется при каждой записи сообщения
+CHAT_PREVIEW_LENGTH = 100
+CHAT_INBOX_PAGE_SIZE = 30
+
+def touch_conversation(cursor, user_login, message_id, sender, text, date):
+    # Сообщение от пользователя +1 к непрочитанным, ответ админа — переписка прочитана
+    from_user = 1 if sender != 'admin' else 0
+    cursor.execute("""INSERT INTO conversations (user_login, last_message_id, last_date, last_sender, preview, unread_count)
+                      VALUES (%s, %s, %s, %s, %s, %s)
+                      ON CONFLICT (user_login) DO UPDATE
+                      SET last_message_id = EXCLUDED.last_message_id, last_date = EXCLUDED.last_date,
+                          last_sender = EXCLUDED.last_sender, preview = EXCLUDED.preview,
+                          unread_count = CASE WHEN EXCLUDED.unread_count = 0 THEN 0
+                                              ELSE conversations.unread_count + 1 END""",
+                   (user_login, message_id, date, sender, (text or '')[:CHAT_PREVIEW_LENGTH], from_user))
+
+def sync_conversations(cursor):
+    # Пересобирает "последнее сообщение" по таблице messages (миграция, импорт); непрочитанные не трогает
+    cursor.execute(f"""INSERT INTO conversations (user_login, last_message_id, last_date, last_sender, preview)
+                       SELECT DISTINCT ON (user_login) user_login, id, date, sender, left(text, {CHAT_PREVIEW_LENGTH})
+                       FROM (SELECT id, date, sender, text,
+                                    CASE WHEN sender = 'admin' THEN receiver ELSE sender END AS user_login
+                             FROM messages WHERE sender = 'admin' OR receiver = 'admin') m
+                       WHERE user_login IS NOT NULL
+                       ORDER BY user_login, id DESC
+                       ON CONFLICT (user_login) DO UPDATE
+                       SET last_message_id = EXCLUDED.last_message_id, last_date = EXCLUDED.last_date,
+                           last_sender = EXCLUDED.last_sender, preview = EXCLUDED.preview
+                       WHERE conversations.last_message_id < EXCLUDED.last_message_id""")
+
+def wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+# =================================================================
+# 👇 ИМПОРТ СТАРЫХ SQLITE-БАЗ: пачками через COPY, с продолжением после обрыва 👇
+# =================================================================
+# Старые версии сайта хранили все в SQLite с разными наборами колонок.
+# Колонка цели -> (кандидаты в старой таблице по порядку, значение по умолчанию)
+LEGACY_TABLES = {
+    # Права и пароли из старых баз не переносим (там admin/admin и подобное): см. legacy_logins
+    'users': [('login', ('login',), None), ('nickname', ('nickname', 'login'), None), ('is_banned', ('is_banned',), 0)],
+    # is_vip из yohkecar_money не переносим: срока оплаты там нет
+    'items': [('owner_login', ('owner_login', 'owner'), None), ('owner_name', ('owner_name', 'owner_login', 'owner'), None),
+              ('title', ('title',), ''), ('price', ('price',), ''), ('description', ('description',), ''),
+              ('contact', ('contact',), ''), ('category', ('category',), 'Другое'), ('region', ('region',), ''),
+              ('city', ('city',), ''), ('image1', ('image1', 'image_url'), ''), ('image2', ('image2',), ''),
+              ('image3', ('image3',), ''), ('image4', ('image4',), ''), ('image5', ('image5',), ''),
+              ('vip_expiry', ('vip_expiry',), 0), ('views', ('views',), 0), ('created_at', ('created_at',), 0)],
+    'reviews': [('item_id', ('item_id',), None), ('author', ('author',), ''), ('text', ('text',), ''),
+                ('stars', ('stars',), None), ('date', ('date',), '')],
+    'messages': [('sender', ('sender',), None), ('receiver', ('receiver',), None), ('text', ('text',), ''), ('date', ('date',), '')],
+    'favorites': [('user_login', ('user_login',), None), ('item_id', ('item_id',), None)],
+}
+LEGACY_BATCH_SIZE = 5000
+LEGACY_PASSWORD = '!legacy'  # не хеш: check_password_hash всегда False, войти можно только после сброса пароля
+LEGACY_SUPPORT_LOGIN = 'admin'  # в messages это не аккаунт, а "поддержка" — оставляем как есть
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def copy_rows(cursor, table, columns, rows):
+    # COPY FROM STDIN в текстовом формате; буфер — только текущая пачка
+    if not rows: return
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join('\\N' if value is None else str(value).translate(COPY_ESCAPES) for value in row) + '\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+def copy_rows_ignoring_duplicates(cursor, table, columns, rows, conflict):
+    # COPY не умеет ON CONFLICT: льем во временную таблицу, оттуда INSERT ... DO NOTHING
+    cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS import_{table} (LIKE {table}) ON COMMIT DELETE ROWS")
+    copy_rows(cursor, f"import_{table}", columns, rows)
+    cursor.execute(f"""INSERT INTO {table} ({', '.join(columns)})
+                       SELECT DISTINCT ON ({conflict}) {', '.join(columns)} FROM import_{table}
+                       ON CONFLICT ({conflict}) DO NOTHING""")
+    return cursor.rowcount
+
+def legacy_item_ids(cursor, source, old_ids):
+    cursor.execute("SELECT old_id, new_id FROM legacy_item_ids WHERE source = %s AND old_id = ANY(%s)", (source, list(old_ids)))
+    return {row['old_id']: row['new_id'] for row in cursor.fetchall()}
+
+def legacy_logins(cursor, source, logins, profiles=None):
+    # Логин из старой базы -> логин в Postgres; -> (соответствие, сколько аккаунтов заведено).
+    # admin не переносим вовсе (его строки пропускаются). Занятый логин (чужой аккаунт, другой файл)
+    # получает суффикс ~<файл>, чтобы объявления, сообщения и избранное не достались постороннему.
+    # Каждому новому — users без прав и без рабочего пароля.
+    logins = {login for login in logins if login and login != 'admin'}
+    if not logins: return {}, 0
+    cursor.execute("SELECT old_login, new_login FROM legacy_logins WHERE source = %s AND old_login = ANY(%s)", (source, list(logins)))
+    mapping = {row['old_login']: row['new_login'] for row in cursor.fetchall()}
+    missing = sorted(logins - set(mapping))
+    if not missing: return mapping, 0
+    cursor.execute("SELECT login FROM users WHERE login = ANY(%s) OR split_part(login, '~', 1) = ANY(%s)", (missing, missing))
+    taken = {row['login'] for row in cursor.fetchall()}
+    stem = os.path.splitext(source)[0]
+    users = []
+    for login in missing:
+        new_login, n = login, 1
+        while new_login in taken:
+            new_login = f"{login}~{stem}" + (str(n) if n > 1 else '')
+            n += 1
+        taken.add(new_login)
+        mapping[login] = new_login
+        nickname, is_banned = (profiles or {}).get(login, (login, 0))
+        users.append((new_login, LEGACY_PASSWORD, nickname, 0, is_banned, 0, 0, 0))
+    copy_rows(cursor, 'users', ['login', 'password', 'nickname', 'is_admin', 'is_banned', 'is_moderator', 'can_ban', 'can_chat'], users)
+    copy_rows(cursor, 'legacy_logins', ['source', 'old_login', 'new_login'], [(source, login, mapping[login]) for login in missing])
+    return mapping, len(users)
+
+def load_legacy_users(cursor, source, rows):
+    profiles = {}
+    for login, nickname, is_banned in rows:
+        if login:
+            profiles.setdefault(login, (nickname or login, 1 if is_banned == 1 else 0))
+    return legacy_logins(cursor, source, profiles, profiles)[1]
+
+def load_legacy_items(cursor, source, rows):
+    owners, _ = legacy_logins(cursor, source, {row[0] for _, row in rows})
+    rows = [(old_id, (owners[row[0]],) + tuple(row[1:])) for old_id, row in rows if row[0] in owners]
+    if not rows: return 0
+    # id выдаем заранее из sequence, чтобы записать соответствие старый -> новый той же пачкой
+    cursor.execute("SELECT nextval(pg_get_serial_sequence('items', 'id')) AS id FROM generate_series(1, %s)", (len(rows),))
+    new_ids = [row['id'] for row in cursor.fetchall()]
+    columns = [col for col, _, _ in LEGACY_TABLES['items']]
+    items = []
+    for new_id, (old_id, row) in zip(new_ids, rows):
+        values = dict(zip(columns, row))
+        # search_vector дозаполнит reindex_search после импорта
+        search_text = search_index_values(values['title'], values['city'], values['description'])[0]
+        items.append((new_id, *row, *price_values(values['price']), search_text))
+    copy_rows(cursor, 'items', ['id'] + columns + ['price_amount', 'price_currency', 'search_text'], items)
+    copy_rows(cursor, 'legacy_item_ids', ['source', 'old_id', 'new_id'],
+              [(source, old_id, new_id) for new_id, (old_id, _) in zip(new_ids, rows)])
+    return len(items)
+
+def load_legacy_reviews(cursor, source, rows):
+    mapping = legacy_item_ids(cursor, source, {row[0] for row in rows})
+    # Отзывы к объявлениям, которых в файле нет, пропускаем
+    reviews = [(mapping[row[0]],) + tuple(row[1:]) for row in rows if row[0] in mapping and row[3] in (1, 2, 3, 4, 5)]
+    copy_rows(cursor, 'reviews', [col for col, _, _ in LEGACY_TABLES['reviews']], reviews)
+    return len(reviews)
+
+def load_legacy_messages(cursor, source, rows):
+    people, _ = legacy_logins(cursor, source, {login for row in rows for login in row[:2]})
+    people[LEGACY_SUPPORT_LOGIN] = LEGACY_SUPPORT_LOGIN
+    messages = [(people[row[0]], people[row[1]]) + tuple(row[2:]) for row in rows if row[0] in people and row[1] in people]
+    copy_rows(cursor, 'messages', [col for col, _, _ in LEGACY_TABLES['messages']], messages)
+    return len(messages)
+
+def load_legacy_favorites(cursor, source, rows):
+    mapping = legacy_item_ids(cursor, source, {row[1] for row in rows})
+    people, _ = legacy_logins(cursor, source, {row[0] for row in rows})
+    favorites = [(people[row[0]], mapping[row[1]]) for row in rows if row[0] in people and row[1] in mapping]
+    return copy_rows_ignoring_duplicates(cursor, 'favorites', ['user_login', 'item_id'], favorites, 'user_login, item_id')
+
+LEGACY_LOADERS = {'users': load_legacy_users, 'items': load_legacy_items, 'reviews': load_legacy_reviews,
+                  'messages': load_legacy_messages, 'favorites': load_legacy_favorites}
+
+def import_legacy_table(cursor, lite, source, table, batch_size):
+    cursor.execute("SELECT last_rowid, rows_imported, done FROM legacy_imports WHERE source = %s AND table_name = %s", (source, table))
+    progress = cursor.fetchone() or {'last_rowid': 0, 'rows_imported': 0, 'done': False}
+    if progress['done']:
+        print(f"   {source}/{table}: уже перенесено ({progress['rows_imported']})")
+        return 0
+
+    existing = {row[1] for row in lite.execute(f'PRAGMA table_info("{table}")')}
+    picks = [(next((c for c in candidates if c in existing), None), default) for _, candidates, default in LEGACY_TABLES[table]]
+    columns_sql = ', '.join(f'"{src}"' for src, _ in picks if src)
+    select_sql = f'SELECT rowid, {columns_sql} FROM "{table}" WHERE rowid > ? ORDER BY rowid LIMIT ?'
+    total = lite.execute(f'SELECT count(*) FROM "{table}" WHERE rowid > ?', (progress['last_rowid'],)).fetchone()[0]
+
+    last_rowid, imported, read = progress['last_rowid'], progress['rows_imported'], 0
+    started = time.perf_counter()
+    while True:
+        batch = lite.execute(select_sql, (last_rowid, batch_size)).fetchall()
+        rows = []
+        for raw in batch:
+            values = iter(raw[1:])
+            row = tuple(next(values) if src else default for src, default in picks)
+            row = tuple(default if value is None else value for value, (_, default) in zip(row, picks))
+            rows.append((raw[0], row) if table == 'items' else row)
+        inserted = LEGACY_LOADERS[table](cursor, source, rows) if rows else 0
+        if batch:
+            last_rowid = batch[-1][0]
+            read += len(batch)
+            imported += inserted
+        # Прогресс пишется в той же транзакции, что и строки: после обрыва продолжим ровно с этой пачки
+        cursor.execute("""INSERT INTO legacy_imports (source, table_name, last_rowid, rows_imported, done)
+                          VALUES (%s, %s, %s, %s, %s)
+                          ON CONFLICT (source, table_name) DO UPDATE
+                          SET last_rowid = EXCLUDED.last_rowid, rows_imported = EXCLUDED.rows_imported, done = EXCLUDED.done""",
+                       (source, table, last_rowid, imported, not batch))
+        cursor.connection.commit()
+        if not batch: break
+        elapsed = time.perf_counter() - started
+        print(f"   {source}/{table}: {read}/{total}, перенесено {imported - progress['rows_imported']} "
+              f"({read / elapsed if elapsed else 0:.0f} строк/с)")
+    return imported - progress['rows_imported']
+
+def import_legacy_file(cursor, path, batch_size=LEGACY_BATCH_SIZE):
+    source = os.path.basename(path)
+    try:
+        lite = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        tables = {row[0] for row in lite.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    except sqlite3.DatabaseError as e:
+        print(f"❌ {source}: не SQLite-база ({e}), пропускаем")
+        return {}
+    print(f"📦 {source}")
+    result = {}
+    try:
+        for table in LEGACY_TABLES:  # порядок важен: отзывы и избранное ссылаются на уже перенесенные объявления
+            if table in tables:
+                result[table] = import_legacy_table(cursor, lite, source, table, batch_size)
+    finally:
+        lite.close()
+    return result
+
+@app.cli.command('import-legacy')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=LEGACY_BATCH_SIZE, help='Строк из SQLite за одну пачку COPY')
+def import_legacy_command(paths, batch_size):
+    """Переносит пользователей, объявления, отзывы, сообщения и избранное из старых SQLite-баз."""
+    conn = get_db_connection()
+    if not conn: return
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    started = time.perf_counter()
+    totals = {}
+    for path in paths:
+        for table, count in import_legacy_file(cursor, path, batch_size).items():
+            totals[table] = totals.get(table, 0) + count
+
+    # Производные данные: поиск, рейтинги, счетчики, переписки, VIP
+    reindex_search(cursor)
+    rebuild_seller_stats(cursor)
+    refresh_site_stats(cursor)
+    sync_conversations(cursor)
+    notify_vip_changed(cursor)
+    cursor.execute("SELECT pg_notify(%s, 'rebuild')", (SUGGEST_CHANNEL,))
+    conn.commit()
+    listing_changed()
+    summary = ', '.join(f"{table}: {count}" for table, count in totals.items()) or 'нечего переносить'
+    print(f"✅ Импорт за {time.perf_counter() - started:.1f} с — {summary}")
+    print("ℹ️ Превью фото для перенесенных объявлений: flask --app main backfill-image-variants")
+    print("ℹ️ Перенесенные пользователи без пароля и прав: войти смогут после сброса пароля администратором")
+
+# =================================================================
+# 👇 ВЫГРУЗКА ДЛЯ ПАРТНЕРОВ: JSONL, CSV, sitemap — потоком, без пагинации 👇
+# =================================================================
+# Строки читаются серверным курсором по EXPORT_CHUNK штук и сразу уходят клиенту: память не зависит от размера таблицы.
+EXPORT_CHUNK = int(os.environ.get('EXPORT_CHUNK', 1000))
+EXPORT_TOKEN = os.environ.get('EXPORT_TOKEN')  # если задан — JSONL/CSV только с ним (sitemap всегда открыт)
+SITEMAP_URLS = 50000                           # лимит URL в одном файле sitemap
+EXPORT_FIELDS = ['id', 'deleted', 'url', 'title', 'price', 'price_amount', 'price_currency', 'description', 'category', 'region',
+                 'city', 'images', 'vip', 'views', 'created_at', 'updated_at']
+
+def record_tombstones(cursor, item_ids, reason):
+    # До commit, в той же транзакции, что удаление/архивация: выгрузка ?since= отдаст их с deleted: true
+    if not item_ids: return
+    cursor.execute("""INSERT INTO deleted_items (id, deleted_at, reason) SELECT unnest(%s::int[]), %s, %s
+                      ON CONFLICT (id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at, reason = EXCLUDED.reason""",
+                   (list(item_ids), time.time(), reason))
+
+def export_items(since=None, id_range=None, columns='*', table='items', changed_column='updated_at'):
+    # Генератор пачек строк; since — только измененные после (по changed_column), иначе все по id
+    conn = get_db_connection()
+    where, params = ["1=1"], []
+    if since is not None:
+        where.append(f"{changed_column} > %s")
+        params.append(since)
+    if id_range is not None:
+        where.append("id >= %s AND id < %s")
+        params.extend(id_range)
+    order = f"{changed_column}, id" if since is not None else "id"
+    cursor = conn.cursor(name=f"export_{uuid.uuid4().hex[:8]}", cursor_factory=RealDictCursor)
+    cursor.itersize = EXPORT_CHUNK
+    try:
+        cursor.execute(f"SELECT {columns} FROM {table} WHERE {' AND '.join(where)} ORDER BY {order}", params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK)
+            if not rows: break
+            yield rows
+    finally:
+        cursor.close()
+        conn.rollback()  # серверный курсор жил в транзакции — закрываем ее, соединение вернется в пул чистым
+
+def export_changes(since):
+    # Живые объявления, а для ?since= еще и удаленные/архивные после since — (запись, удалено ли)
+    for rows in export_items(since):
+        yield [(item, False) for item in rows]
+    if since is None: return
+    for rows in export_items(since, columns='id, deleted_at', table='deleted_items', changed_column='deleted_at'):
+        yield [(item, True) for item in rows]
+
+def tombstone_record(item):
+    return {'id': item['id'], 'deleted': True, 'updated_at': item['deleted_at']}
+
+def export_record(item, base_url, now):
+    return {
+        'id': item['id'], 'deleted': False, 'url': f"{base_url}/item/{item['id']}", 'title': item['title'], 'price': item['price'],
+        'price_amount': float(item['price_amount']) if item['price_amount'] is not None else None,
+        'price_currency': item['price_currency'] or None, 'description': item['description'],
+        'category': item['category'], 'region': item['region'], 'city': item['city'],
+        'images': [item[f'image{i}'] for i in range(1, 6) if item[f'image{i}'] and item[f'image{i}'] != NO_PHOTO_URL],
+        'vip': (item['vip_expiry'] or 0) > now, 'views': (item['views'] or 0) + view_counter.pending(item['id']),
+        'created_at': item['created_at'], 'updated_at': item['updated_at'],
+    }
+
+def export_since():
+    # ?since=<unix time>; неверное значение — ошибка, а не молча полная выгрузка
+    raw = request.args.get('since')
+    if raw in (None, ''): return None
+    return float(raw)
+
+def export_allowed():
+    if not EXPORT_TOKEN: return True
+    return request.args.get('token') == EXPORT_TOKEN or request.headers.get('Authorization') == f"Bearer {EXPORT_TOKEN}"
+
+def streamed(chunks, mimetype, filename=None):
+    headers = {'X-Accel-Buffering': 'no'}  # nginx не должен копить ответ целиком
+    if filename:
+        headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+# =================================================================
+# 👇 ПОЛЬЗОВАТЕЛИ И ПРАВА: запись users из кэша воркера, сброс по NOTIFY 👇
+# =================================================================
+# Права и бан проверяются на каждом запросе, но из памяти: запрос в базу — раз в USER_CACHE_TTL на пользователя.
+# ban/unban/set_right шлют NOTIFY user_changed — запись выкидывается во всех воркерах сразу.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CHANNEL = 'user_changed'
+SESSION_RIGHTS = ('is_admin', 'is_moderator', 'can_ban', 'can_chat')
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def on_user_notify(payload):
+    if payload is None:
+        user_cache.clear()  # переподключились — что-то могли пропустить
+    else:
+        user_cache.pop(payload)
+
+pg_listener.subscribe(USER_CHANNEL, on_user_notify)
+
+def get_user_record(login):
+    pg_listener.ensure()
+    record = user_cache.get(login)
+    if record is None:
+        conn = get_db_connection()
+        if not conn: return None
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("SELECT login, nickname, is_admin, is_banned, is_moderator, can_ban, can_chat FROM users WHERE login = %s", (login,))
+        record = cursor.fetchone()
+        if record is None: return None
+        user_cache.set(login, record)
+    return record
+
+def notify_user_changed(cursor, login):
+    # Вызывать до commit; после commit — еще и user_cache.pop(login) в этом воркере
+    cursor.execute("SELECT pg_notify(%s, %s)", (USER_CHANNEL, login))
+
+def session_rights(user_data):
+    # Те же правила, что при входе: у админа все права
+    if user_data['is_admin'] == 1:
+        return {'is_admin': 1, 'is_moderator': 1, 'can_ban': 1, 'can_chat': 1}
+    return {'is_admin': 0, 'is_moderator': user_data['is_moderator'], 'can_ban': user_data['can_ban'], 'can_chat': user_data['can_chat']}
+
+@app.before_request
+def refresh_session_user():
+    # Бан и смена прав действуют сразу, а не со следующего входа
+    if request.endpoint in ('static', 'asset') or 'user' not in session: return
+    record = get_user_record(session['user'])
+    if record is None:
+        if get_db_connection() is None: return  # база недоступна — не выкидываем из аккаунта
+        session.clear()
+        return
+    if record['is_banned'] == 1:
+        session.clear()
+        return
+    for name, value in session_rights(record).items():
+        if session.get(name) != value:
+            session[name] = value
+
+# =================================================================
+# 👇 ОГРАНИЧЕНИЕ ЧАСТОТЫ: скользящее окно, общее для воркеров машины, без Postgres 👇
+# =================================================================
+# Счетчики лежат в SQLite-файле в CACHE_DIR (WAL, без fsync): проверка — десятки микросекунд.
+# Окно скользящее по двум корзинам: предыдущая учитывается с весом оставшейся доли окна.
+# Лимит: (по кому — 'user' | 'ip', сколько, за сколько секунд, текст отказа); переопределяется RATE_LIMIT_<ИМЯ>=сколько/секунд
+def rate_limit_setting(name, scope, limit, window, message):
+    override = os.environ.get(f'RATE_LIMIT_{name.upper()}')
+    if override:
+        limit, window = (int(part) for part in override.split('/'))
+    return scope, limit, window, message
+
+RATE_LIMITS = {
+    'create': rate_limit_setting('create', 'user', 3, 24 * 60 * 60,
+                                 "<h1>🚫 Ошибка!</h1><p>Вы исчерпали лимит ({limit} объявления в сутки).</p><a href='/'>На главную</a>"),
+    'login': rate_limit_setting('login', 'ip', 10, 5 * 60, "Слишком много попыток входа. Попробуйте через {retry} сек."),
+    'register': rate_limit_setting('register', 'ip', 5, 60 * 60, "Слишком много регистраций. Попробуйте через {retry} сек."),
+    'send_support': rate_limit_setting('send_support', 'user', 20, 60, "Слишком много сообщений. Подождите {retry} сек."),
+    'add_review': rate_limit_setting('add_review', 'user', 10, 60 * 60, "Слишком много отзывов. Попробуйте через {retry} сек."),
+}
+RATE_LIMIT_DB = os.path.join(CACHE_DIR, 'ratelimit.sqlite3')
+RATE_LIMIT_CLEANUP_EVERY = 1000  # раз в столько проверок потока чистим истекшие корзины
+
+
+class RateLimiter:
+    """Скользящее окно на SQLite-файле: одно соединение на поток, атомарно через BEGIN IMMEDIATE."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.allowed = 0
+        self.rejected = 0
+
+    def _conn(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""CREATE TABLE IF NOT EXISTS hits
+                            (key TEXT, bucket INTEGER, count INTEGER NOT NULL, expires_at REAL NOT NULL,
+                             PRIMARY KEY (key, bucket)) WITHOUT ROWID""")
+            local.conn, local.pid, local.calls = conn, os.getpid(), 0
+        return local.conn
+
+    def hit(self, key, limit, window):
+        # None — можно (и попытка засчитана), иначе через сколько секунд станет можно
+        now = time.time()
+        bucket = int(now // window)
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                counts = dict(conn.execute("SELECT bucket, count FROM hits WHERE key = ? AND bucket IN (?, ?)",
+                                           (key, bucket - 1, bucket)).fetchall())
+                elapsed = (now % window) / window
+                estimate = counts.get(bucket - 1, 0) * (1 - elapsed) + counts.get(bucket, 0)
+                if estimate >= limit:
+                    conn.execute("COMMIT")
+                    self.rejected += 1
+                    return max(1, math.ceil(window * (1 - elapsed)))
+                conn.execute("""INSERT INTO hits (key, bucket, count, expires_at) VALUES (?, ?, 1, ?)
+                                ON CONFLICT (key, bucket) DO UPDATE SET count = count + 1""",
+                             (key, bucket, (bucket + 2) * window))
+                self._local.calls += 1
+                if self._local.calls % RATE_LIMIT_CLEANUP_EVERY == 0:
+                    conn.execute("DELETE FROM hits WHERE expires_at < ?", (now,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # Хранилище счетчиков недоступно — пропускаем, сайт важнее лимита
+            print(f"❌ Ограничитель частоты не работает: {e}")
+            return None
+        self.allowed += 1
+        return None
+
+    def stats(self):
+        return {'allowed': self.allowed, 'rejected': self.rejected}
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_DB)
+
+# X-Forwarded-For заполняет клиент, верить можно только записям, которые дописали наши прокси (справа).
+# TRUSTED_PROXY_HOPS — сколько прокси перед gunicorn (Replit, nginx): ProxyFix берет адрес ровно перед ними.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+def client_ip():
+    return request.remote_addr or '-'
+
+def rate_limited(name):
+    # Декоратор маршрута: ограничивает только POST; админ не ограничен
+    scope, limit, window, message = RATE_LIMITS[name]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method == 'POST' and session.get('is_admin') != 1:
+                who = f"user:{session['user']}" if scope == 'user' and 'user' in session else f"ip:{client_ip()}"
+                retry = rate_limiter.hit(f"{name}:{who}", limit, window)
+                if retry is not None:
+                    return message.format(limit=limit, retry=retry), 429, {'Retry-After': str(retry)}
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# =================================================================
+# 👇 ИЗБРАННОЕ: множество id в кэше воркера, переключение одним запросом 👇
+# =================================================================
+# Множество избранного пользователя читается раз в FAVORITES_CACHE_TTL; "лайкнуто ли" — O(1) по set.
+# Свой воркер правит множество на месте, остальные сбрасывают его по NOTIFY favorites_changed.
+FAVORITES_CACHE_TTL = float(os.environ.get('FAVORITES_CACHE_TTL', 300))
+FAVORITES_CACHE_SIZE = int(os.environ.get('FAVORITES_CACHE_SIZE', 10000))
+FAVORITES_CHANNEL = 'favorites_changed'
+FAVORITES_BATCH_MAX = 200  # id за один запрос к /api/favorites
+favorites_cache = TTLCache(FAVORITES_CACHE_SIZE, FAVORITES_CACHE_TTL)
+
+FAVORITE_TOGGLE_SQL = """WITH removed AS (DELETE FROM favorites WHERE user_login = %s AND item_id = %s RETURNING item_id)
+                         INSERT INTO favorites (user_login, item_id)
+                         SELECT %s, id FROM items WHERE id = %s AND NOT EXISTS (SELECT 1 FROM removed)
+                         ON CONFLICT DO NOTHING
+                         RETURNING item_id"""
+
+def on_favorites_notify(payload):
+    if payload is None:
+        favorites_cache.clear()
+    elif payload.split(':', 1)[0] != process_token():
+        favorites_cache.pop(payload.split(':', 1)[1])
+
+pg_listener.subscribe(FAVORITES_CHANNEL, on_favorites_notify)
+
+def user_favorites(cursor, user_login):
+    # frozenset id избранных объявлений пользователя
+    pg_listener.ensure()
+    favorites = favorites_cache.get(user_login)
+    if favorites is None:
+        cursor = cursor.connection.cursor()
+        cursor.execute("SELECT item_id FROM favorites WHERE user_login = %s", (user_login,))
+        favorites = frozenset(row[0] for row in cursor.fetchall())
+        favorites_cache.set(user_login, favorites)
+    return favorites
+
+def favorites_changed(cursor, user_login, liked=(), unliked=()):
+    # До commit: оповещаем другие воркеры (своя метка в payload — себе не сбрасываем)
+    cursor.execute("SELECT pg_notify(%s, %s)", (FAVORITES_CHANNEL, f"{process_token()}:{user_login}"))
+    return lambda: update_cached_favorites(user_login, liked, unliked)
+
+def update_cached_favorites(user_login, liked, unliked):
+    # После commit: правим множество этого воркера на месте, без перечитывания
+    favorites = favorites_cache.get(user_login)
+    if favorites is not None:
+        favorites_cache.set(user_login, (favorites | frozenset(liked)) - frozenset(unliked))
+
+def toggle_favorite(cursor, user_login, item_id):
+    # Один запрос: удалили — значит было в избранном; иначе вставили (если объявление существует)
+    cursor.execute(FAVORITE_TOGGLE_SQL, (user_login, item_id, user_login, item_id))
+    liked = cursor.fetchone() is not None
+    return liked, favorites_changed(cursor, user_login, liked=[item_id] if liked else [], unliked=[] if liked else [item_id])
+
+def set_favorites(cursor, user_login, like_ids, unlike_ids):
+    # Идемпотентно: повтор того же запроса ничего не меняет
+    if like_ids:
+        cursor.execute("""INSERT INTO favorites (user_login, item_id)
+                          SELECT %s, id FROM items WHERE id = ANY(%s)
+                          ON CONFLICT DO NOTHING""", (user_login, list(like_ids)))
+    if unlike_ids:
+        cursor.execute("DELETE FROM favorites WHERE user_login = %s AND item_id = ANY(%s)", (user_login, list(unlike_ids)))
+    return favorites_changed(cursor, user_login, liked=like_ids, unliked=unlike_ids)
+
+# =================================================================
+# 👇 АРХИВ: старые объявления без движения уезжают в холодные таблицы 👇
+# =================================================================
+# Лента, поиск, выгрузки и site_stats работают только с горячими items, поэтому их объем
+# определяется живыми объявлениями, а не всей историей. Перенос — по расписанию:
+#   flask --app main archive-stale [--dry-run]
+# В архив попадает объявление старше ARCHIVE_AFTER_DAYS, которое не правили ARCHIVE_IDLE_DAYS
+# и у которого нет действующего VIP. Вместе с ним переносятся отзывы и избранное.
+# Архивное открывается по /item/<id>, владелец возвращает его в ленту через /restore/<id>.
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_IDLE_DAYS = float(os.environ.get('ARCHIVE_IDLE_DAYS', 30))
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', 500))
+REVIEW_COLUMNS = "id, item_id, author, text, stars, date"
+
+ARCHIVE_CANDIDATES_WHERE = "created_at < %s AND COALESCE(updated_at, created_at) < %s AND vip_expiry <= %s"
+
+_item_columns = None
+
+def item_columns(cursor):
+    # Колонки items через запятую: переносим строки по именам, порядок в items_archive может отличаться
+    global _item_columns
+    if _item_columns is None:
+        cursor = cursor.connection.cursor()
+        cursor.execute("""SELECT column_name FROM information_schema.columns
+                          WHERE table_schema = current_schema() AND table_name = 'items' ORDER BY ordinal_position""")
+        _item_columns = ", ".join(row[0] for row in cursor.fetchall())
+    return _item_columns
+
+def shift_seller_stats(cursor, item_ids, sign):
+    # sign=-1: отзывы объявлений перестают учитываться в рейтинге продавца, +1 — снова учитываются
+    cursor.execute("""INSERT INTO seller_stats (seller_login, review_count, star_sum)
+                      SELECT i.owner_login, %s * count(*), %s * COALESCE(sum(r.stars), 0)
+                      FROM reviews r JOIN items i ON i.id = r.item_id
+                      WHERE i.id = ANY(%s) GROUP BY i.owner_login
+                      ON CONFLICT (seller_login) DO UPDATE
+                      SET review_count = seller_stats.review_count + EXCLUDED.review_count,
+                          star_sum = seller_stats.star_sum + EXCLUDED.star_sum""", (sign, sign, list(item_ids)))
+
+def archive_cutoffs():
+    # Параметры для ARCHIVE_CANDIDATES_WHERE
+    now = time.time()
+    return (now - ARCHIVE_AFTER_DAYS * 86400, now - ARCHIVE_IDLE_DAYS * 86400, now)
+
+def stale_item_ids(cursor, limit):
+    # Самые старые кандидаты; SKIP LOCKED — не ждем строки, которые сейчас правят
+    cursor = cursor.connection.cursor()
+    cursor.execute(f"""SELECT id FROM items WHERE {ARCHIVE_CANDIDATES_WHERE}
+                       ORDER BY created_at LIMIT %s FOR UPDATE SKIP LOCKED""", archive_cutoffs() + (limit,))
+    return [row[0] for row in cursor.fetchall()]
+
+def moved_favorites_callbacks(cursor, moved, liked):
+    # moved — [(user_login, item_id)]; по одному NOTIFY на пользователя, колбэки — после commit
+    by_user = {}
+    for user_login, item_id in moved:
+        by_user.setdefault(user_login, []).append(item_id)
+    if liked:
+        return [favorites_changed(cursor, user_login, liked=ids) for user_login, ids in by_user.items()]
+    return [favorites_changed(cursor, user_login, unliked=ids) for user_login, ids in by_user.items()]
+
+def archive_items(cursor, item_ids):
+    # До commit. -> (перенесенные id, колбэки после commit)
+    if not item_ids: return [], []
+    cursor = cursor.connection.cursor()
+    columns = item_columns(cursor)
+    shift_seller_stats(cursor, item_ids, -1)
+    cursor.execute(f"""WITH moved AS (DELETE FROM reviews WHERE item_id = ANY(%s) RETURNING {REVIEW_COLUMNS})
+                       INSERT INTO reviews_archive ({REVIEW_COLUMNS}) SELECT {REVIEW_COLUMNS} FROM moved""", (list(item_ids),))
+    # Избранное забираем до удаления items, иначе его снесет ON DELETE CASCADE
+    cursor.execute("""WITH moved AS (DELETE FROM favorites WHERE item_id = ANY(%s) RETURNING user_login, item_id)
+                      INSERT INTO favorites_archive (user_login, item_id) SELECT user_login, item_id FROM moved
+                      ON CONFLICT DO NOTHING RETURNING user_login, item_id""", (list(item_ids),))
+    callbacks = moved_favorites_callbacks(cursor, cursor.fetchall(), liked=False)
+    cursor.execute(f"""WITH moved AS (DELETE FROM items WHERE id = ANY(%s) RETURNING {columns})
+                       INSERT INTO items_archive ({columns}, archived_at) SELECT {columns}, %s FROM moved
+                       RETURNING id, title, city, views""", (list(item_ids), time.time()))
+    rows = cursor.fetchall()
+    record_tombstones(cursor, [row[0] for row in rows], 'archived')
+    bump_site_stat(cursor, 'items', -len(rows))
+    bump_site_stat(cursor, 'views', -sum(views or 0 for _, _, _, views in rows))
+    for _, title, city, _ in rows:
+        notify_suggest_changed(cursor, old=(title, city))
+    return [row[0] for row in rows], callbacks
+
+def unarchive_item(cursor, item_id):
+    # До commit. -> колбэки после commit или None, если в архиве такого нет.
+    # updated_at = сейчас: возвращенное снова простоит ARCHIVE_IDLE_DAYS, прежде чем уехать в архив
+    cursor = cursor.connection.cursor()
+    columns = item_columns(cursor)
+    cursor.execute(f"""WITH moved AS (DELETE FROM items_archive WHERE id = %s RETURNING {columns})
+                       INSERT INTO items ({columns}) SELECT {columns} FROM moved
+                       RETURNING title, city, views""", (item_id,))
+    row = cursor.fetchone()
+    if row is None: return None
+    title, city, views = row
+    # updated_at = сейчас: выгрузка ?since= снова отдаст объявление, надгробие больше не нужно
+    cursor.execute("UPDATE items SET updated_at = %s WHERE id = %s", (time.time(), item_id))
+    cursor.execute("DELETE FROM deleted_items WHERE id = %s", (item_id,))
+    cursor.execute(f"""WITH moved AS (DELETE FROM reviews_archive WHERE item_id = %s RETURNING {REVIEW_COLUMNS})
+                       INSERT INTO reviews ({REVIEW_COLUMNS}) SELECT {REVIEW_COLUMNS} FROM moved""", (item_id,))
+    shift_seller_stats(cursor, [item_id], 1)
+    cursor.execute("""WITH moved AS (DELETE FROM favorites_archive WHERE item_id = %s RETURNING user_login, item_id)
+                      INSERT INTO favorites (user_login, item_id) SELECT user_login, item_id FROM moved
+                      ON CONFLICT DO NOTHING RETURNING user_login, item_id""", (item_id,))
+    callbacks = moved_favorites_callbacks(cursor, cursor.fetchall(), liked=True)
+    bump_site_stat(cursor, 'items', 1)
+    bump_site_stat(cursor, 'views', views or 0)
+    notify_suggest_changed(cursor, new=(title, city))
+    return callbacks
+
+@app.cli.command('archive-stale')
+@click.option('--batch-size', default=ARCHIVE_BATCH, show_default=True, help='Объявлений за транзакцию')
+@click.option('--dry-run', is_flag=True, help='Только посчитать, сколько уедет в архив')
+def archive_stale_command(batch_size, dry_run):
+    """Переносит старые объявления без движения в архивные таблицы."""
+    conn = get_db_connection()
+    if not conn: raise SystemExit(1)
+    cursor = conn.cursor()
+    if dry_run:
+        cursor.execute(f"SELECT count(*) FROM items WHERE {ARCHIVE_CANDIDATES_WHERE}", archive_cutoffs())
+        print(f"В архив уедет объявлений: {cursor.fetchone()[0]}")
+        return
+    done = 0
+    while True:
+        archived, callbacks = archive_items(cursor, stale_item_ids(cursor, batch_size))
+        conn.commit()
+        if not archived: break
+        for update_cache in callbacks:
+            update_cache()
+        for item_id in archived:
+            listing_changed(item_id)
+        done += len(archived)
+        print(f"… в архиве {done}")
+    print(f"✅ Перенесено в архив: {done}")
+
+# --- ROUTES ---
+@app.route('/')
+def home():
+    if 'user' in session:
+        current_user_login = session['user']
+        current_user_name = session.get('nickname')
+        user_is_admin = session.get('is_admin')
+    else:
+        current_user_login = None
+        current_user_name = None
+        user_is_admin = 0
+
+    page = request.args.get('page', 1, type=int)
+    search_query = request.args.get('q', '')
+    category_filter = request.args.get('cat', '')
+    country_filter = request.args.get('country', '')
+    min_price_filter = request.args.get('min_price', '')
+    max_price_filter = request.args.get('max_price', '')
+    sort = request.args.get('sort', '')
+    if sort not in FEED_SORTS: sort = ''
+    min_price, _ = parse_price(min_price_filter)
+    max_price, _ = parse_price(max_price_filter)
+
+    cache_key = (page, search_query, category_filter, country_filter, min_price, max_price, sort)
+    cached = feed_cache.get(cache_key)
+    if cached and not current_user_login and cached['html'] is not None:
+        return cached['html']
+
+    conn = None
+    if not cached or current_user_login:
+        conn = get_db_connection()
+        if not conn: return "Ошибка подключения к базе данных"
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    liked_ids = user_favorites(cursor, current_user_login) if current_user_login else frozenset()
+
+    if not cached:
+        where, params, order, order_params = build_feed_filters(search_query, category_filter, country_filter, min_price, max_price, sort)
+        scope = repr(cache_key[1:])
+        after = parse_feed_cursor(request.args.get('cursor'), page, scope, vip_roster.ids(cursor))
+        items, total_pages, next_cursor = fetch_feed_page(cursor, where, params, page, after, order, order_params, scope)
+        cached = {'items': items, 'total_pages': total_pages, 'next_cursor': next_cursor, 'html': None}
+        # В кэш (общий для всех посетителей) — только страницу, посчитанную через OFFSET.
+        # Страница по курсору зависит от того, когда курсор выдан (VIP мог истечь), — ее не сохраняем.
+        if after is None:
+            feed_cache.set(cache_key, cached, expires_at=next_vip_change(cursor))
+
+    # Копии, чтобы просмотры воркера не накапливались в закэшированных строках
+    items_to_show = view_counter.apply([dict(item) for item in cached['items']])
+    html = render_template('index.html', user_login=current_user_login, user_name=current_user_name, is_admin=user_is_admin, items=items_to_show, search_query=search_query, category_filter=category_filter, country_filter=country_filter, min_price_filter=min_price_filter, max_price_filter=max_price_filter, sort=sort, page=page, total_pages=cached['total_pages'], next_cursor=cached['next_cursor'], time=time, liked_ids=liked_ids)
+    if not current_user_login:
+        cached['html'] = html
+    return html
+
+@app.route('/suggest')
+def suggest():
+    # Подсказки к строке поиска: из памяти воркера, без запросов к базе
+    response = jsonify(suggestions=suggest_index.suggest(request.args.get('q', '')))
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
 
 @app.route('/fav/<int:item_id>')
 def toggle_fav(item_id):
     if 'user' not in session: return redirect('/login')
     conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM favorites WHERE user_login = %s AND item_id = %s", (session['user'], item_id))
-    exists = cursor.fetchone()
-    if exists:
-        cursor.execute("DELETE FROM favorites WHERE user_login = %s AND item_id = %s", (session['user'], item_id))
-    else:
-        cursor.execute("INSERT INTO favorites (user_login, item_id) VALUES (%s, %s)", (session['user'], item_id))
+    cursor = conn.cursor()
+    _, update_cache = toggle_favorite(cursor, session['user'], item_id)
     conn.commit()
-    conn.close()
+    update_cache()
     return redirect(request.referrer or '/')
 
+@app.route('/api/favorites', methods=['POST'])
+def favorites_api():
+    # {"check": [id, ...], "set": {"id": true|false, ...}, "toggle": [id, ...]} -> {"liked": {"id": bool, ...}}
+    if 'user' not in session: return jsonify(error="Сначала войдите!"), 401
+    data = request.get_json(silent=True) or {}
+    try:
+        check = [int(i) for i in data.get('check', [])]
+        changes = {int(i): bool(v) for i, v in (data.get('set') or {}).items()}
+        toggle = [int(i) for i in data.get('toggle', [])]
+    except (TypeError, ValueError, AttributeError):
+        return jsonify(error="Ожидались id объявлений"), 400
+    if len(check) + len(changes) + len(toggle) > FAVORITES_BATCH_MAX:
+        return jsonify(error=f"Не больше {FAVORITES_BATCH_MAX} id за запрос"), 400
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    updates = []
+    if changes:
+        updates.append(set_favorites(cursor, session['user'], [i for i, v in changes.items() if v], [i for i, v in changes.items() if not v]))
+    toggled = {}
+    for item_id in toggle:
+        toggled[item_id], update_cache = toggle_favorite(cursor, session['user'], item_id)
+        updates.append(update_cache)
+    if updates:
+        conn.commit()
+        for update_cache in updates:
+            update_cache()
+    favorites = user_favorites(cursor, session['user'])
+    liked = {str(i): i in favorites for i in check + list(changes)}
+    liked.update({str(i): v for i, v in toggled.items()})
+    return jsonify(liked=liked)
+
 @app.route('/favorites')
 def favorites_page():
     if 'user' not in session: return redirect('/login')
@@ -257,8 +2901,7 @@ def favorites_page():
         ORDER BY favorites.item_id DESC
     """, (session['user'],))
     items = cursor.fetchall()
-    liked_ids = [item['id'] for item in items]
-    conn.close()
+    liked_ids = {item['id'] for item in items}
     return render_template('favorites.html', items=items, liked_ids=liked_ids, time=time)
 
 @app.route('/my_ads')
@@ -267,9 +2910,11 @@ def my_ads():
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     cursor.execute("SELECT * FROM items WHERE owner_login = %s ORDER BY id DESC", (session['user'],))
-    items = cursor.fetchall()
-    conn.close()
-    return render_template('index.html', items=items, user_login=session['user'], user_name=session.get('nickname'), is_admin=session.get('is_admin'), search_query="", category_filter="", page=1, total_pages=1, time=time, liked_ids=[])
+    items = view_counter.apply(cursor.fetchall())
+    cursor.execute("""SELECT id, title, price, price_amount, price_currency, archived_at FROM items_archive
+                      WHERE owner_login = %s ORDER BY id DESC""", (session['user'],))
+    archived_items = cursor.fetchall()
+    return render_template('index.html', items=items, archived_items=archived_items, user_login=session['user'], user_name=session.get('nickname'), is_admin=session.get('is_admin'), search_query="", category_filter="", page=1, total_pages=1, time=time, liked_ids=[])
 
 @app.route('/support')
 def support_chat():
@@ -277,52 +2922,59 @@ def support_chat():
     my_login = session['user']
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("""
-        SELECT * FROM messages 
-        WHERE (sender = %s AND receiver = 'admin') 
-           OR (sender = 'admin' AND receiver = %s)
-        ORDER BY id ASC
-    """, (my_login, my_login))
-    messages = cursor.fetchall()
-    conn.close()
-    return render_template('support.html', messages=messages)
+    messages = conversation_messages(cursor, my_login)
+    return render_template('support.html', messages=messages, has_more=len(messages) == CHAT_PAGE_SIZE)
+
+@app.route('/support/messages')
+def support_messages():
+    # ?after=<id>[&wait=сек] — новые (long-poll), ?before=<id> — предыдущая страница
+    if 'user' not in session: return jsonify(error="login"), 401
+    return chat_messages_response(session['user'])
 
 @app.route('/send_support', methods=['POST'])
+@rate_limited('send_support')
 def send_support():
     if 'user' not in session: return redirect('/login')
     text = request.form.get('text')
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO messages (sender, receiver, text, date) VALUES (%s, 'admin', %s, %s)", 
-                   (session['user'], text, time.strftime("%d.%m %H:%M")))
+    date = time.strftime("%d.%m %H:%M")
+    cursor.execute("INSERT INTO messages (sender, receiver, text, date) VALUES (%s, 'admin', %s, %s) RETURNING id", 
+                   (session['user'], text, date))
+    message_id = cursor.fetchone()[0]
+    touch_conversation(cursor, session['user'], message_id, session['user'], text, date)
     conn.commit()
-    conn.close()
+    chat_generation(session['user']).bump()
+    if wants_json(): return jsonify(id=message_id)
     return redirect('/support')
 
 @app.route('/admin/chats')
 def admin_chats():
     if session.get('is_admin') != 1 and session.get('can_chat') != 1: return "Нет прав"
+    page = max(request.args.get('page', 1, type=int), 1)
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT DISTINCT sender FROM messages WHERE receiver = 'admin'")
-    senders = cursor.fetchall()
-    conn.close()
-    return render_template('admin_chats.html', senders=senders)
+    cursor.execute("""SELECT user_login, last_message_id, last_date, last_sender, preview, unread_count
+                      FROM conversations ORDER BY last_message_id DESC LIMIT %s OFFSET %s""",
+                   (CHAT_INBOX_PAGE_SIZE + 1, (page - 1) * CHAT_INBOX_PAGE_SIZE))
+    conversations = cursor.fetchall()
+    has_next = len(conversations) > CHAT_INBOX_PAGE_SIZE
+    return render_template('admin_chats.html', conversations=conversations[:CHAT_INBOX_PAGE_SIZE], page=page, has_next=has_next)
 
 @app.route('/admin/chat/<user_login>')
 def admin_chat_detail(user_login):
     if session.get('is_admin') != 1 and session.get('can_chat') != 1: return "Нет прав"
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("""
-        SELECT * FROM messages 
-        WHERE (sender = %s AND receiver = 'admin') 
-           OR (sender = 'admin' AND receiver = %s)
-        ORDER BY id ASC
-    """, (user_login, user_login))
-    messages = cursor.fetchall()
-    conn.close()
-    return render_template('admin_chat_detail.html', messages=messages, client_login=user_login)
+    messages = conversation_messages(cursor, user_login)
+    cursor.execute("UPDATE conversations SET unread_count = 0 WHERE user_login = %s AND unread_count > 0", (user_login,))
+    conn.commit()
+    return render_template('admin_chat_detail.html', messages=messages, client_login=user_login, has_more=len(messages) == CHAT_PAGE_SIZE)
+
+@app.route('/admin/chat/<user_login>/messages')
+def admin_chat_messages(user_login):
+    if session.get('is_admin') != 1 and session.get('can_chat') != 1: return jsonify(error="forbidden"), 403
+    return chat_messages_response(user_login, mark_read=True)
 
 @app.route('/admin/send_reply', methods=['POST'])
 def admin_send_reply():
@@ -331,10 +2983,14 @@ def admin_send_reply():
     text = request.form.get('text')
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO messages (sender, receiver, text, date) VALUES ('admin', %s, %s, %s)", 
-                   (client_login, text, time.strftime("%d.%m %H:%M")))
+    date = time.strftime("%d.%m %H:%M")
+    cursor.execute("INSERT INTO messages (sender, receiver, text, date) VALUES ('admin', %s, %s, %s) RETURNING id", 
+                   (client_login, text, date))
+    message_id = cursor.fetchone()[0]
+    touch_conversation(cursor, client_login, message_id, 'admin', text, date)
     conn.commit()
-    conn.close()
+    chat_generation(client_login).bump()
+    if wants_json(): return jsonify(id=message_id)
     return redirect(f'/admin/chat/{client_login}')
 
 @app.route('/make_vip/<int:item_id>/<int:days>')
@@ -344,9 +3000,11 @@ def make_vip(item_id, days):
     expiry_time = time.time() + duration_seconds
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE items SET vip_expiry = %s WHERE id = %s", (expiry_time, item_id))
+    cursor.execute("UPDATE items SET vip_expiry = %s, updated_at = %s WHERE id = %s", (expiry_time, time.time(), item_id))
+    notify_vip_changed(cursor)
     conn.commit()
-    conn.close()
+    vip_roster.invalidate()
+    listing_changed(item_id)
     return redirect(f'/item/{item_id}')
 
 @app.route('/remove_vip/<int:item_id>')
@@ -354,9 +3012,11 @@ def remove_vip(item_id):
     if session.get('is_admin') != 1: return "Плати деньги!"
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE items SET vip_expiry = 0 WHERE id = %s", (item_id,))
+    cursor.execute("UPDATE items SET vip_expiry = 0, updated_at = %s WHERE id = %s", (time.time(), item_id))
+    notify_vip_changed(cursor)
     conn.commit()
-    conn.close()
+    vip_roster.invalidate()
+    listing_changed(item_id)
     return redirect(f'/item/{item_id}')
 
 @app.route('/item/<int:item_id>')
@@ -366,24 +3026,15 @@ def item_detail(item_id):
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
 
-    cursor.execute("UPDATE items SET views = views + 1 WHERE id = %s", (item_id,))
-    conn.commit()
-
-    cursor.execute("SELECT * FROM items WHERE id = %s", (item_id,))
-    item = cursor.fetchone()
-
-    if not item: return "Товар не найден!"
-
-    is_liked = False
-    if current_user_login:
-        cursor.execute("SELECT * FROM favorites WHERE user_login = %s AND item_id = %s", (current_user_login, item_id))
-        if cursor.fetchone(): is_liked = True
+    page = get_item_page(cursor, item_id, current_user_login)
+    if not page: return "Товар не найден!"
+    item, reviews, (rating, reviews_count), is_liked = page
 
-    cursor.execute("SELECT * FROM reviews WHERE item_id = %s ORDER BY id DESC", (item_id,))
-    reviews = cursor.fetchall()
-    conn.close()
-    seller_rating, reviews_count = get_seller_rating(item['owner_login'])
-    return render_template('detail.html', item=item, reviews=reviews, user_login=current_user_login, is_admin=user_is_admin, rating=seller_rating, reviews_count=reviews_count, time=time, is_liked=is_liked)
+    if not item.get('archived_at'):
+        view_counter.hit(item_id)
+    item = dict(item)  # запись из кэша общая — просмотры добавляем в копию
+    view_counter.apply([item])
+    return render_template('detail.html', item=item, reviews=reviews, user_login=current_user_login, is_admin=user_is_admin, rating=rating, reviews_count=reviews_count, time=time, is_liked=is_liked)
 
 @app.route('/edit/<int:item_id>', methods=['GET', 'POST'])
 def edit_item(item_id):
@@ -393,7 +3044,6 @@ def edit_item(item_id):
     cursor.execute("SELECT * FROM items WHERE id = %s", (item_id,))
     item = cursor.fetchone()
     if not item or (item['owner_login'] != session['user'] and session.get('is_admin') != 1):
-        conn.close()
         return "Нельзя редактировать чужое!"
     if request.method == 'POST':
         title = request.form.get('title')
@@ -403,15 +3053,17 @@ def edit_item(item_id):
         category = request.form.get('category')
         region = request.form.get('region')
         city = request.form.get('city')
-        cursor.execute("""UPDATE items SET title=%s, price=%s, description=%s, contact=%s, category=%s, region=%s, city=%s WHERE id=%s""", 
-             (title, price, description, contact, category, region, city, item_id))
+        cursor.execute(f"""UPDATE items SET title=%s, price=%s, price_amount=%s, price_currency=%s, description=%s, contact=%s, category=%s, region=%s, city=%s,
+                           updated_at=%s, search_text=%s, search_vector={SEARCH_VECTOR_SQL} WHERE id=%s""", 
+             (title, price, *price_values(price), description, contact, category, region, city, time.time()) + search_index_values(title, city, description) + (item_id,))
+        notify_suggest_changed(cursor, old=(item['title'], item['city']), new=(title, city))
         conn.commit()
-        conn.close()
+        listing_changed(item_id)
         return redirect(f'/item/{item_id}')
-    conn.close()
     return render_template('edit.html', item=item)
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limited('register')
 def register():
     if request.method == 'POST':
         login = request.form.get('login')
@@ -422,7 +3074,6 @@ def register():
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         cursor.execute("SELECT * FROM users WHERE login = %s", (login,))
         if cursor.fetchone():
-            conn.close()
             return "Занят!"
 
         # ЗАЩИТА: Хешируем пароль
@@ -430,12 +3081,13 @@ def register():
 
         cursor.execute("INSERT INTO users (login, password, nickname, is_admin, is_banned, is_moderator, can_ban, can_chat) VALUES (%s, %s, %s, %s, 0, 0, 0, 0)", 
                        (login, hash_password, nickname, is_admin_val))
+        bump_site_stat(cursor, 'users', 1)
         conn.commit()
-        conn.close()
         return redirect('/login')
     return render_template('register.html')
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limited('login')
 def login():
     if request.method == 'POST':
         login = request.form.get('login')
@@ -445,7 +3097,6 @@ def login():
 
         cursor.execute("SELECT * FROM users WHERE login = %s", (login,))
         user_data = cursor.fetchone()
-        conn.close()
 
         # Сверяем хеш пароля
         if user_data and check_password_hash(user_data['password'], password):
@@ -453,17 +3104,7 @@ def login():
 
             session['user'] = login
             session['nickname'] = user_data['nickname']
-
-            if user_data['is_admin'] == 1:
-                session['is_admin'] = 1
-                session['is_moderator'] = 1
-                session['can_ban'] = 1
-                session['can_chat'] = 1
-            else:
-                session['is_admin'] = 0
-                session['is_moderator'] = user_data['is_moderator']
-                session['can_ban'] = user_data['can_ban']
-                session['can_chat'] = user_data['can_chat']
+            session.update(session_rights(user_data))
 
             return redirect('/')
         else: return "Неверно!"
@@ -476,22 +3117,11 @@ def logout():
 
 # --- СОЗДАНИЕ С ЗАГРУЗКОЙ В CLOUDINARY ---
 @app.route('/create', methods=['GET', 'POST'])
+@rate_limited('create')
 def create():
     if 'user' not in session: return "Сначала войдите!"
 
     if request.method == 'POST':
-        if session.get('is_admin') != 1:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            day_ago = time.time() - (24 * 60 * 60)
-            cursor.execute("SELECT count(*) FROM items WHERE owner_login = %s AND created_at > %s", (session['user'], day_ago))
-            count = cursor.fetchone()[0]
-            conn.close()
-
-            LIMIT = 3
-            if count >= LIMIT:
-                return f"<h1>🚫 Ошибка!</h1><p>Вы исчерпали лимит ({LIMIT} объявления в сутки).</p><a href='/'>На главную</a>"
-
         title = request.form.get('title')
         price = request.form.get('price')
         description = request.form.get('text')
@@ -500,42 +3130,43 @@ def create():
         region = request.form.get('region')
         city = request.form.get('city')
 
-        image_paths = []
-        for i in range(1, 6):
-            file = request.files.get(f'image{i}')
-            if file and file.filename != '':
-                try:
-                    # ОТПРАВЛЯЕМ В ОБЛАКО CLOUDINARY
-                    upload_result = cloudinary.uploader.upload(file)
-                    image_paths.append(upload_result['secure_url'])
-                except Exception as e:
-                    print(f"Ошибка загрузки фото: {e}")
-                    image_paths.append("")
-            else: 
-                image_paths.append("")
-
-        if image_paths[0] == "": image_paths[0] = "https://placehold.co/400x300/EEE/31343C?text=Нет+фото"
+        images = read_uploaded_images(request.files)
+        if IMAGE_UPLOAD_ASYNC:
+            image_paths, image_variants = pending_image_urls(images), [None] * 5
+        else:
+            image_paths, image_variants = upload_images(images)
 
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        cursor.execute("""INSERT INTO items (owner_login, owner_name, title, price, description, contact, category, region, city, image1, image2, image3, image4, image5, vip_expiry, views, created_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0, 0, %s)""", 
-            (session['user'], session['nickname'], title, price, description, contact, category, region, city, image_paths[0], image_paths[1], image_paths[2], image_paths[3], image_paths[4], time.time()))
+        cursor.execute(f"""INSERT INTO items (owner_login, owner_name, title, price, price_amount, price_currency, description, contact, category, region, city, image1, image2, image3, image4, image5, image_variants, vip_expiry, views, created_at, search_text, search_vector) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0, 0, %s, %s, {SEARCH_VECTOR_SQL}) RETURNING id""", 
+            (session['user'], session['nickname'], title, price, *price_values(price), description, contact, category, region, city, image_paths[0], image_paths[1], image_paths[2], image_paths[3], image_paths[4], Json(image_variants), time.time()) + search_index_values(title, city, description))
+        item_id = cursor.fetchone()[0]
+        bump_site_stat(cursor, 'items', 1)
+        notify_suggest_changed(cursor, new=(title, city))
         conn.commit()
-        conn.close()
+        listing_changed(item_id)
+        if IMAGE_UPLOAD_ASYNC and any(images):
+            spool_item_images(item_id, images)
+            # Отдельная очередь: фоновая стадия сама ждет потоки 'upload'
+            get_executor('background', 2).submit(finish_item_images, item_id, images)
         return redirect('/')
     return render_template('create.html')
 
 @app.route('/add_review/<int:item_id>', methods=['POST'])
+@rate_limited('add_review')
 def add_review(item_id):
     if 'user' not in session: return "Войдите!"
     text = request.form.get('text')
-    stars = request.form.get('stars')
+    stars = request.form.get('stars', type=int)
+    if stars not in (1, 2, 3, 4, 5): return "Ошибка"
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("INSERT INTO reviews (item_id, author, text, stars, date) VALUES (%s, %s, %s, %s, %s)", (item_id, session.get('nickname'), text, stars, time.strftime("%d.%m.%Y")))
+    add_seller_review(cursor, item_id, stars)
     conn.commit()
-    conn.close()
+    # Отзывы в ленту не попадают — сбрасываем только страницу товара, не ленту и не курсоры
+    item_generation(item_id).bump()
     return redirect(f'/item/{item_id}')
 
 @app.route('/delete/<int:item_id>')
@@ -543,46 +3174,64 @@ def delete_item(item_id):
     if 'user' not in session: return "Вход не выполнен"
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT owner_login FROM items WHERE id = %s", (item_id,))
+    cursor.execute("SELECT owner_login, views, title, city FROM items WHERE id = %s", (item_id,))
     item = cursor.fetchone()
     if item and (item['owner_login'] == session['user'] or session.get('is_admin') == 1 or session.get('can_ban') == 1):
+        remove_item_reviews_from_stats(cursor, item_id, item['owner_login'])
         cursor.execute("DELETE FROM items WHERE id = %s", (item_id,))
+        record_tombstones(cursor, [item_id], 'deleted')
+        bump_site_stat(cursor, 'items', -1)
+        bump_site_stat(cursor, 'views', -(item['views'] or 0))
+        notify_suggest_changed(cursor, old=(item['title'], item['city']))
         conn.commit()
-    conn.close()
+        listing_changed(item_id)
     return redirect('/')
 
+@app.route('/restore/<int:item_id>')
+def restore_item(item_id):
+    # Вернуть объявление из архива в ленту
+    if 'user' not in session: return "Вход не выполнен"
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("SELECT owner_login FROM items_archive WHERE id = %s", (item_id,))
+    item = cursor.fetchone()
+    if not item or (item['owner_login'] != session['user'] and session.get('is_admin') != 1):
+        return "Нельзя вернуть чужое!"
+    callbacks = unarchive_item(cursor, item_id)
+    conn.commit()
+    for update_cache in callbacks or []:
+        update_cache()
+    listing_changed(item_id)
+    return redirect(f'/item/{item_id}')
+
 @app.route('/admin')
 def admin_panel():
     if session.get('is_admin') != 1 and session.get('is_moderator') != 1: return "Нет прав!"
 
+    page = max(request.args.get('page', 1, type=int), 1)
+    search_query = request.args.get('q', '').strip()
+
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
 
-    # 1. Берем всех пользователей
-    cursor.execute("SELECT * FROM users ORDER BY is_admin DESC, is_moderator DESC")
+    # 1. Пользователи — одна страница, сначала босс и модераторы
+    where, params = "", []
+    if search_query:
+        where = "WHERE login ILIKE %s OR nickname ILIKE %s"
+        params = [f"%{search_query}%", f"%{search_query}%"]
+    cursor.execute(f"""SELECT login, nickname, is_admin, is_banned, is_moderator, can_ban, can_chat FROM users {where}
+                       ORDER BY is_admin DESC, is_moderator DESC, login LIMIT %s OFFSET %s""",
+                   params + [ADMIN_USERS_PAGE_SIZE + 1, (page - 1) * ADMIN_USERS_PAGE_SIZE])
     users = cursor.fetchall()
+    has_next = len(users) > ADMIN_USERS_PAGE_SIZE
 
-    # 2. СЧИТАЕМ СТАТИСТИКУ
-    # Всего юзеров
-    total_users = len(users)
+    # 2. СТАТИСТИКА — готовые счетчики (+ просмотры, которые воркер еще не записал)
+    stats = get_site_stats(cursor)
 
-    # Всего объявлений
-    cursor.execute("SELECT count(*) as cnt FROM items")
-    res_items = cursor.fetchone()
-    total_items = res_items['cnt'] if res_items else 0
-
-    # Общие просмотры
-    cursor.execute("SELECT sum(views) as total_views FROM items")
-    res_views = cursor.fetchone()['total_views']
-    total_views = res_views if res_views else 0
-
-    conn.close()
-
-    # ИСПРАВЛЕНО ЗДЕСЬ: используем total_items вместо items
-    return render_template('admin.html', users=users, stats={
-        'users': total_users,
-        'total_items': total_items, 
-        'views': int(total_views)
+    return render_template('admin.html', users=users[:ADMIN_USERS_PAGE_SIZE], page=page, has_next=has_next, search_query=search_query, stats={
+        'users': stats.get('users', 0),
+        'total_items': stats.get('items', 0), 
+        'views': int(stats.get('views', 0) + view_counter.pending_total())
     })
 
 @app.route('/set_right/<user_login>/<right_name>/<int:value>')
@@ -596,8 +3245,9 @@ def set_right(user_login, right_name, value):
     cursor = conn.cursor()
     query = f"UPDATE users SET {right_name} = %s WHERE login = %s"
     cursor.execute(query, (value, user_login))
+    notify_user_changed(cursor, user_login)
     conn.commit()
-    conn.close()
+    user_cache.pop(user_login)
     return redirect('/admin')
 
 @app.route('/ban/<login_to_ban>')
@@ -606,8 +3256,9 @@ def ban_user(login_to_ban):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("UPDATE users SET is_banned = 1 WHERE login = %s", (login_to_ban,))
+    notify_user_changed(cursor, login_to_ban)
     conn.commit()
-    conn.close()
+    user_cache.pop(login_to_ban)
     return redirect('/admin')
 
 @app.route('/unban/<login_to_unban>')
@@ -616,10 +3267,102 @@ def unban_user(login_to_unban):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("UPDATE users SET is_banned = 0 WHERE login = %s", (login_to_unban,))
+    notify_user_changed(cursor, login_to_unban)
     conn.commit()
-    conn.close()
+    user_cache.pop(login_to_unban)
     return redirect('/admin')
 
+@app.route('/admin/db_pool')
+def admin_db_pool():
+    # Для подбора числа воркеров под лимит соединений базы
+    if session.get('is_admin') != 1: return "Нет прав!"
+    return jsonify(pid=os.getpid(), **get_db_pool().stats())
+
+@app.route('/admin/cache_stats')
+def admin_cache_stats():
+    if session.get('is_admin') != 1: return "Нет прав!"
+    return jsonify(pid=os.getpid(), feed=feed_cache.stats(), item=item_cache.stats(), card=card_cache.stats(), vip_roster=vip_roster.stats(),
+                   suggest=suggest_index.stats(), user=user_cache.stats(),
+                   favorites=favorites_cache.stats(), rate_limit=rate_limiter.stats(),
+                   assets=asset_manifest.stats())
+
+@app.route('/metrics')
+def metrics():
+    # Без METRICS_TOKEN метрики открыты только в debug: в них пути, нагрузка и размеры кэшей
+    if not METRICS_TOKEN:
+        if not app.debug: return "Нет прав! Задайте METRICS_TOKEN", 403
+    elif not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return "Нет прав!", 403
+    return Response(prometheus_text(metrics_registry.collect_all()), mimetype='text/plain; version=0.0.4')
+
+@app.route('/export/items.jsonl')
+def export_jsonl():
+    if not export_allowed(): return "Нет прав!", 403
+    try: since = export_since()
+    except ValueError: return "since — время в секундах (unix)", 400
+    base_url, now = request.url_root.rstrip('/'), time.time()
+
+    def generate():
+        for rows in export_changes(since):
+            yield ''.join(json.dumps(tombstone_record(item) if deleted else export_record(item, base_url, now), ensure_ascii=False) + '\n'
+                          for item, deleted in rows)
+    return streamed(generate(), 'application/x-ndjson', 'items.jsonl')
+
+@app.route('/export/items.csv')
+def export_csv():
+    if not export_allowed(): return "Нет прав!", 403
+    try: since = export_since()
+    except ValueError: return "since — время в секундах (unix)", 400
+    base_url, now = request.url_root.rstrip('/'), time.time()
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+        writer.writeheader()
+        for rows in export_changes(since):
+            for item, deleted in rows:
+                if deleted:
+                    writer.writerow(tombstone_record(item))
+                    continue
+                record = export_record(item, base_url, now)
+                record['images'] = ' '.join(record['images'])
+                writer.writerow(record)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    return streamed(generate(), 'text/csv', 'items.csv')
+
+@app.route('/sitemap.xml')
+def sitemap_index():
+    # Индекс: по файлу на каждые SITEMAP_URLS id — номера файлов считаются от max(id), без count(*)
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("SELECT max(id) AS max_id FROM items")
+    max_id = cursor.fetchone()['max_id'] or 0
+    base_url = request.url_root.rstrip('/')
+    parts = ''.join(f"<sitemap><loc>{base_url}/sitemap-items-{n}.xml</loc></sitemap>"
+                    for n in range(max_id // SITEMAP_URLS + 1))
+    return Response('<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                    + parts + '</sitemapindex>\n', mimetype='application/xml')
+
+@app.route('/sitemap-items-<int:part>.xml')
+def sitemap_items(part):
+    base_url = request.url_root.rstrip('/')
+
+    def generate():
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        for rows in export_items(id_range=(part * SITEMAP_URLS, (part + 1) * SITEMAP_URLS), columns='id, updated_at'):
+            yield ''.join(f"<url><loc>{base_url}/item/{item['id']}</loc>"
+                          f"<lastmod>{time.strftime('%Y-%m-%d', time.gmtime(item['updated_at'] or 0))}</lastmod></url>\n"
+                          for item in rows)
+        yield '</urlset>\n'
+    return streamed(generate(), 'application/xml')
+
+@app.route('/robots.txt')
+def robots_txt():
+    return Response(f"User-agent: *\nSitemap: {request.url_root.rstrip('/')}/sitemap.xml\n", mimetype='text/plain')
+
 @app.route('/policy')
 def policy():
     return render_template('policy.html')
@@ -629,4 +3372,8 @@ def terms():
     return render_template('terms.html')
 
 if __name__ == '__main__':
+    # Локальный запуск: мигрируем сами (на проде это делает release-команда из Procfile)
+    with app.app_context():
+        conn = get_db_connection()
+        if conn: migrate(conn)
     app.run(host='0.0.0.0', port=8080)
\ No newline at end of file